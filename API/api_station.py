@@ -1,3 +1,6 @@
+import asyncio
+import concurrent.futures
+import contextlib
 import datetime
 import hashlib
 import json
@@ -8,11 +11,16 @@ import traceback
 
 # Requirements
 from fastapi import FastAPI, HTTPException, Request, Response, status
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 import sqlalchemy as sa
 
+from cache import TTLCache
 from common import USERNAME, PASSWORD
-from models.Machines import MachineAtSite, MachineObs, t_MachineObsRejected, Metadata
+from ingest import GroupCommitter, RejectedSink
+from metrics import INSERTS, REJECTED, checkout_session, instrument, instrument_pool
+from rollups import RollupRefresher
+from models.Machines import MachineAtSite, MachineObs, MachineObsLatest, t_MachineObsRejected, Metadata
 
 
 # Database connection settings
@@ -27,10 +35,128 @@ engine = create_async_engine(
     pool_pre_ping=True,     # Default is False
 )
 
+# Rejected payloads are buffered and written in bulk by a background task, with a
+# single connection of their own; so a misconfigured station spamming bad data
+# does not compete with the observations for the pool above
+engine_rejected = create_async_engine(
+    DATABASE_URL,
+    pool_size=1,
+    max_overflow=0,
+    pool_recycle=7200,
+    pool_pre_ping=True,
+)
+
+
+# Cache of the current siteID of every logger (loggerID -> siteID), a logger is
+# assigned to another site maybe once a year. /register invalidates the entry, the
+# TTL covers the assignments changed directly in the database.
+SITE_CACHE_TTL = int(os.environ.get('SITE_CACHE_TTL', 600))
+site_cache = TTLCache(ttl=SITE_CACHE_TTL)
+
+# Reverse DNS of the clients (IP -> hostname). The lookups run in a small thread
+# pool, so a slow resolver does not block the event loop, and they time out after
+# DNS_TIMEOUT seconds; then the IP is used instead, and cached for a short time.
+DNS_TIMEOUT = float(os.environ.get('DNS_TIMEOUT', 2))
+DNS_CACHE_TTL = 3600
+DNS_FAILURE_TTL = 60
+dns_cache = TTLCache(ttl=DNS_CACHE_TTL, maxsize=1000)
+dns_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='dns')
+dns_pending = {}  # IP -> Future, to resolve only once concurrent requests from the same client
+
+# Maximum number of records accepted by /insert_batch
+MAX_BATCH_SIZE = 1000
+
+# Fix data to be inserted
+translation_map = [
+    ('git_version', None),
+    ('Charge_Battery1', 'Charge_Battery'),  # Renamed
+    ('Temp_Battery1', 'Temp_Battery'),      # Renamed
+    ('Charge_Battery2', None),              # Removed
+    ('Temp_Battery2', None),                # Removed
+    ('U_Battery2', None),                   # Removed
+]
+
+# Mapping from the record fields to the MachineObs columns, precomputed once: the
+# renames and removals of translation_map are applied, and unknown fields dropped.
+# The received column is set by the database.
+OBS_COLUMNS = frozenset(column.name for column in MachineObs.__table__.columns)
+OBS_FIELDS = {name: name for name in OBS_COLUMNS if name != 'received'} | dict(translation_map)
+
+# Statement to insert one observation, the SQLAlchemy compiled cache reuses its
+# compiled form for every set of columns (stations send always the same fields)
+OBS_INSERT = sa.insert(MachineObs.__table__).values(received=sa.func.now())
+
+
+def latest_upsert():
+    """Statement to keep MachineObsLatest, the last observation of every logger, up
+    to date. Every column is updated only if the row is newer than the stored one;
+    the timestamp goes last because the assignments see the values already updated.
+    """
+    table = MachineObsLatest.__table__
+    stmt = mysql_insert(table).values(received=sa.func.now())
+    newer = stmt.inserted.timestamp > table.c.timestamp
+    names = [column.name for column in table.columns if column.name not in ('loggerID', 'timestamp')]
+    return stmt.on_duplicate_key_update([
+        (name, sa.func.IF(newer, stmt.inserted[name], table.c[name])) for name in names + ['timestamp']
+    ])
+
+
+# The rows are given all the columns, so the ones missing are set to NULL
+LATEST_COLUMNS = [column.name for column in MachineObsLatest.__table__.columns if column.name != 'received']
+LATEST_UPSERT = latest_upsert()
+
+
+# Opt-in group commit of observations: with INGEST_MODE=group the rows accepted by
+# /insert are queued, and written every GROUP_COMMIT_ROWS rows or every
+# GROUP_COMMIT_DELAY milliseconds, with a single commit. The response is sent once
+# the row is committed.
+INGEST_MODE = os.environ.get('INGEST_MODE', 'direct')
+GROUP_COMMIT_ROWS = int(os.environ.get('GROUP_COMMIT_ROWS', 100))
+GROUP_COMMIT_DELAY = int(os.environ.get('GROUP_COMMIT_DELAY', 50))
+committer = None
+
+# Identical rejected payloads (same domain, reason and data) are written once every
+# REJECTED_WINDOW seconds, at most REJECTED_BUFFER_SIZE are buffered between writes
+REJECTED_WINDOW = int(os.environ.get('REJECTED_WINDOW', 60))
+REJECTED_BUFFER_SIZE = int(os.environ.get('REJECTED_BUFFER_SIZE', 1000))
+
+# The hourly and daily aggregates of the inserted rows are updated every
+# ROLLUP_INTERVAL seconds (0 disables it)
+ROLLUP_INTERVAL = int(os.environ.get('ROLLUP_INTERVAL', 60))
+rollup_refresher = RollupRefresher(engine, interval=ROLLUP_INTERVAL)
+
 
 ENV = os.environ.get('ENV')
 root_path = "/post" if ENV else None
-app = FastAPI(root_path=root_path)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    global committer
+    rejected_sink.start()
+    if ROLLUP_INTERVAL > 0:
+        rollup_refresher.start()
+    if INGEST_MODE == 'group':
+        committer = GroupCommitter(
+            flush_rows,
+            key=lambda row: (row['loggerID'], parse_timestamp(row['timestamp'])),
+            max_rows=GROUP_COMMIT_ROWS,
+            max_delay=GROUP_COMMIT_DELAY / 1000,
+        )
+        committer.start()
+    yield
+    if committer is not None:
+        await committer.stop()
+        committer = None
+    await rejected_sink.stop()
+    if ROLLUP_INTERVAL > 0:
+        await rollup_refresher.stop()
+
+
+app = FastAPI(root_path=root_path, lifespan=lifespan)
+instrument(app, 'api_station')
+instrument_pool(engine, 'api_station')
+instrument_pool(engine_rejected, 'api_station', 'rejected')
 
 
 #testing API via browser
@@ -41,7 +167,7 @@ async def route_test():
 #main API script
 @app.post("/insert")
 async def addData(request: Request):
-    domain = get_domain(request)
+    domain = await get_domain(request)
 
     # json parsing
     data = await request.json()
@@ -55,87 +181,286 @@ async def addData(request: Request):
             timestamp = data.get('timestamp')
             sign = data.pop('sign', None)
             if not (loggerID and timestamp and sign):
-                return await submitRejectedJSON(session, "Incorrect JSON body", myjson, domain)
+                return submitRejectedJSON("Incorrect JSON body", myjson, domain)
 
             # Check timestamp
             now = datetime.datetime.now() + datetime.timedelta(minutes=1000)
             if not ('2010-01-01 00:00:01' < timestamp < str(now)):
-                return await submitRejectedJSON(session, "Invalid timestamp", myjson, domain)
+                return submitRejectedJSON("Invalid timestamp", myjson, domain)
+            try:
+                parse_timestamp(timestamp)
+            except ValueError:
+                return submitRejectedJSON("Invalid timestamp", myjson, domain)
 
             # Get siteID
-            result = await session.execute(
-                sa.select(MachineAtSite)
-                    .filter_by(loggerID=loggerID)
-                    .order_by(MachineAtSite.startDate.desc())
-                    .limit(1)
-            )
-
-            row = result.scalar()
-            if row is None:
-                return await submitRejectedJSON(session, "Station ID not registered", myjson, domain)
-
-            siteID = row.siteID
+            siteID = await get_site_id(session, loggerID)
+            if siteID is None:
+                return submitRejectedJSON("Station ID not registered", myjson, domain)
 
             # Check signature
             key = f"{siteID}; {loggerID}; {timestamp}"
             hash = hashlib.sha256(key.encode('utf-8')).hexdigest()
             if hash != sign:
-                return await submitRejectedJSON(session, "Incorrect hash", myjson, domain)
+                return submitRejectedJSON("Incorrect hash", myjson, domain)
 
         #catch error while parsing json
         except Exception:
             traceback.print_exc()
-            return await submitRejectedJSON(session, "Incorrect JSON body", myjson, domain)
+            return submitRejectedJSON("Incorrect JSON body", myjson, domain)
 
         # Fix data to be inserted
-        translation_map = [
-            ('git_version', None),
-            ('Charge_Battery1', 'Charge_Battery'),  # Renamed
-            ('Temp_Battery1', 'Temp_Battery'),      # Renamed
-            ('Charge_Battery2', None),              # Removed
-            ('Temp_Battery2', None),                # Removed
-            ('U_Battery2', None),                   # Removed
-        ]
-        for src, dst in translation_map:
-            if src in data:
-                value = data.pop(src)
-                if dst is not None:
-                    assert dst not in data
-                    data[dst] = value
+        row = obs_row(data)
 
         try:
-            await insert(session, MachineObs, received=sa.func.now(), **data)
+            if committer is None:
+                await insert_obs(session, row)
+            else:
+                # Do not hold a connection while waiting for the group commit
+                await session.close()
+                if not await committer.submit(row):
+                    INSERTS.labels('duplicate').inc()
+                    return "Duplicate data NOT inserted"
 
             # TODO Change to 201 once the stations are updated
+            INSERTS.labels('new').inc()
             return "New record inserted"
         except sa.exc.IntegrityError as exc:
             errcode = exc.orig.args[0]
             if errcode == 1062:
+                INSERTS.labels('duplicate').inc()
                 return "Duplicate data NOT inserted"
             else:
                 raise
         except Exception:
             traceback.print_exc()
-            return await submitRejectedJSON(session, "Hashcheck ok, but insertion failed.", myjson, domain)
+            INSERTS.labels('failed').inc()
+            return submitRejectedJSON("Hashcheck ok, but insertion failed.", myjson, domain)
+
+@app.post("/insert_batch")
+async def addBatch(request: Request):
+    """Insert a list of signed records, as replayed by stations after an outage.
+
+    Every record is validated as in /insert, then all the accepted records are
+    written with a single multi-row INSERT and a single commit.
+    """
+    domain = await get_domain(request)
+
+    records = await request.json()
+    if not isinstance(records, list):
+        raise HTTPException(status_code=400, detail='Expected a list of records')
+    if len(records) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f'At most {MAX_BATCH_SIZE} records per batch')
+
+    accepted = []
+    duplicates = []
+    rejected = []
+
+    async with AsyncSession(engine) as session:
+        # Get siteIDs, one query for the whole batch
+        # The records with another type of loggerID are rejected below
+        loggerIDs = {data.get('loggerID') for data in records
+                     if isinstance(data, dict) and isinstance(data.get('loggerID'), str)}
+        sites = await get_site_ids(session, loggerIDs)
+
+        # Validate
+        rows = {}
+        for index, data in enumerate(records):
+            try:
+                data = data.copy()
+                reason = check_record(data, sites)
+                if reason is None:
+                    data = obs_row(data)
+                    key = data['loggerID'], parse_timestamp(data['timestamp'])
+            except Exception:
+                reason = "Incorrect JSON body"
+
+            if reason is not None:
+                rejected.append((index, reason))
+            elif key in rows:
+                duplicates.append(index)
+            else:
+                rows[key] = index, data
+
+        # Insert
+        if rows:
+            try:
+                existing = await insert_many(session, [data for index, data in rows.values()])
+            except Exception:
+                traceback.print_exc()
+                await session.rollback()
+                for index, data in rows.values():
+                    rejected.append((index, "Hashcheck ok, but insertion failed."))
+                INSERTS.labels('failed').inc(len(rows))
+            else:
+                for key, (index, data) in rows.items():
+                    if key in existing:
+                        duplicates.append(index)
+                    else:
+                        accepted.append(index)
+                INSERTS.labels('new').inc(len(accepted))
+        INSERTS.labels('duplicate').inc(len(duplicates))
+
+    # Rejected records
+    for index, reason in rejected:
+        submitRejectedJSON(reason, json.dumps(records[index]), domain)
+
+    return {
+        'accepted': sorted(accepted),
+        'duplicates': sorted(duplicates),
+        'rejected': [{'index': index, 'reason': reason} for index, reason in sorted(rejected)],
+    }
 
 #insert rejected functions
-async def submitRejectedJSON(session, text, json, domain):
+def submitRejectedJSON(text, json, domain):
     # XXX Should be 202 Accepted
-    await insert_t(session, t_MachineObsRejected,
-       domain=domain,
-       comment=text,
-       received=sa.func.now(6),
-       data=json,
-    )
-
+    REJECTED.labels(text).inc()
+    rejected_sink.put(domain, text, json)
     return text
 
-def get_domain(request):
-    """Client domain extraction."""
+async def flush_rejected(rows):
+    """Write the rejected payloads buffered by the sink, with their own engine."""
+    async with AsyncSession(engine_rejected) as session:
+        await checkout_session(session)
+        await session.execute(sa.insert(t_MachineObsRejected), rows)
+        await session.commit()
+
+rejected_sink = RejectedSink(flush_rejected, maxsize=REJECTED_BUFFER_SIZE, window=REJECTED_WINDOW)
+
+def obs_row(data):
+    """Return the MachineObs row of a record, mapping its fields with OBS_FIELDS."""
+    row = {}
+    for name, value in data.items():
+        column = OBS_FIELDS.get(name)
+        if column is not None:
+            assert column not in row
+            row[column] = value
+
+    return row
 
-    # socket.gethostbyaddr is I/O bound, ideally this should be async
+def latest_row(row):
+    """Return the MachineObsLatest row of an observation (see LATEST_UPSERT)."""
+    return {name: row.get(name) for name in LATEST_COLUMNS}
+
+
+def parse_timestamp(timestamp):
+    """Parse a record timestamp, as stored by MariaDB (without fractional seconds)."""
+    if not isinstance(timestamp, datetime.datetime):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    return timestamp.replace(microsecond=0)
+
+def check_record(data, sites):
+    """Validate a record, return the reason it is rejected or None if valid.
+
+    Args:
+        data: the record, the 'sign' field is popped
+        sites: dictionary mapping loggerID to siteID
+    Returns:
+        None if the record is valid, otherwise the rejection reason
+    """
+    # Check required fields
+    loggerID = data.get('loggerID')
+    timestamp = data.get('timestamp')
+    sign = data.pop('sign', None)
+    if not (loggerID and timestamp and sign):
+        return "Incorrect JSON body"
+
+    # Check timestamp
+    now = datetime.datetime.now() + datetime.timedelta(minutes=1000)
+    if not ('2010-01-01 00:00:01' < timestamp < str(now)):
+        return "Invalid timestamp"
+    try:
+        parse_timestamp(timestamp)
+    except ValueError:
+        return "Invalid timestamp"
+
+    # Check siteID
+    siteID = sites.get(loggerID)
+    if siteID is None:
+        return "Station ID not registered"
+
+    # Check signature
+    key = f"{siteID}; {loggerID}; {timestamp}"
+    hash = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    if hash != sign:
+        return "Incorrect hash"
+
+    return None
+
+async def get_site_id(session: AsyncSession, loggerID):
+    """Return the current siteID of the given logger, or None if not registered."""
+    siteID = site_cache.get(loggerID)
+    if siteID is None:
+        await checkout_session(session)
+        result = await session.execute(
+            sa.select(MachineAtSite.siteID)
+                .filter_by(loggerID=loggerID)
+                .order_by(MachineAtSite.startDate.desc())
+                .limit(1)
+        )
+        siteID = result.scalar()
+        if siteID is not None:
+            site_cache.set(loggerID, siteID)
+
+    return siteID
+
+async def get_site_ids(session: AsyncSession, loggerIDs):
+    """Return a dictionary mapping every given loggerID to its current siteID.
+
+    Loggers that are not registered are missing from the result.
+    """
+    sites = {}
+    missing = []
+    for loggerID in loggerIDs:
+        if isinstance(loggerID, str):
+            siteID = site_cache.get(loggerID)
+            if siteID is None:
+                missing.append(loggerID)
+            else:
+                sites[loggerID] = siteID
+
+    if missing:
+        await checkout_session(session)
+        result = await session.execute(
+            sa.select(MachineAtSite.loggerID, MachineAtSite.siteID)
+                .where(MachineAtSite.loggerID.in_(missing))
+                .order_by(MachineAtSite.startDate)
+        )
+
+        # The latest assignment wins
+        found = {loggerID: siteID for loggerID, siteID in result}
+        for loggerID, siteID in found.items():
+            site_cache.set(loggerID, siteID)
+        sites.update(found)
+
+    return sites
+
+async def get_domain(request):
+    """Client domain extraction."""
 
     host = request.client.host  # Client's hostname or IP address
+    hostname = dns_cache.get(host)
+    if hostname is not None:
+        return hostname
+
+    future = dns_pending.get(host)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(dns_executor, gethostbyaddr, host)
+        dns_pending[host] = future
+        future.add_done_callback(lambda f: dns_pending.pop(host, None))
+
+    try:
+        # Shield the future, it is shared with other requests
+        hostname = await asyncio.wait_for(asyncio.shield(future), DNS_TIMEOUT)
+    except (asyncio.TimeoutError, OSError):
+        dns_cache.set(host, host, ttl=DNS_FAILURE_TTL)
+        return host
+
+    dns_cache.set(host, hostname)
+    return hostname
+
+def gethostbyaddr(host):
+    """Blocking reverse DNS lookup, returns the hostname."""
     try:
         hostname, aliaslist, ipaddrlist = socket.gethostbyaddr(host)
     except OSError:
@@ -168,6 +493,68 @@ async def insert(session: AsyncSession, model, **kwargs):
     await session.commit()
 
 
+async def insert_obs(session: AsyncSession, row):
+    """Insert one observation with the precompiled Core statement, and commit.
+
+    This is the hot path, it skips the ORM: no model instance, no unit of work.
+
+    Args:
+        session: AsyncSession instance
+        row: dictionary with the column values of MachineObs (see obs_row)
+    """
+    # Parsed first, so nothing can fail once the row is committed
+    timestamp = parse_timestamp(row['timestamp'])
+    await checkout_session(session)
+    await session.execute(OBS_INSERT, row)
+    await session.execute(LATEST_UPSERT, latest_row(row))
+    await session.commit()
+    rollup_refresher.mark(row['loggerID'], timestamp)
+
+
+async def insert_many(session: AsyncSession, rows):
+    """Insert many observations with a single multi-row INSERT and commit.
+
+    Rows already stored are left untouched (INSERT ... ON DUPLICATE KEY).
+
+    Args:
+        session: AsyncSession instance
+        rows: list of dictionaries with the column values of MachineObs (see obs_row)
+    Returns:
+        The set of (loggerID, timestamp) keys that were already stored
+    """
+    # Every row must have the same keys
+    columns = set().union(*rows)
+    values = [{k: row.get(k) for k in columns} | {'received': sa.func.now()} for row in rows]
+
+    # Find the rows already stored, one index range scan per logger
+    timestamps = [parse_timestamp(row['timestamp']) for row in rows]
+    await checkout_session(session)
+    result = await session.execute(
+        sa.select(MachineObs.loggerID, MachineObs.timestamp)
+            .where(MachineObs.loggerID.in_({row['loggerID'] for row in rows}))
+            .where(MachineObs.timestamp.between(min(timestamps), max(timestamps)))
+    )
+    existing = set(result.tuples())
+
+    # The no-op update makes duplicates (including races with /insert) harmless
+    stmt = mysql_insert(MachineObs).values(values)
+    stmt = stmt.on_duplicate_key_update(loggerID=stmt.inserted.loggerID)
+    await session.execute(stmt)
+    # Sorted, so concurrent batches lock the snapshot rows in the same order
+    await session.execute(LATEST_UPSERT, sorted(map(latest_row, rows), key=lambda row: row['loggerID']))
+    await session.commit()
+    for row, timestamp in zip(rows, timestamps):
+        rollup_refresher.mark(row['loggerID'], timestamp)
+
+    return existing
+
+
+async def flush_rows(rows):
+    """Write a group of observations queued by the group committer."""
+    async with AsyncSession(engine) as session:
+        return await insert_many(session, rows)
+
+
 async def insert_t(session: AsyncSession, table, **kwargs):
     """Insert a new record into a Core-style Table.
 
@@ -217,7 +604,7 @@ async def update(session: AsyncSession, model, where, **kwargs):
 
 @app.post("/register")
 async def register(request: Request, response: Response):
-    domain = get_domain(request)
+    domain = await get_domain(request)
 
     # Input data
     data = await request.json()
@@ -274,7 +661,21 @@ async def register(request: Request, response: Response):
             raise
     else:
         status_code = status.HTTP_201_CREATED
+    finally:
+        # The logger may have been assigned to another site
+        site_cache.pop(loggerID)
 
     # Return
     response.status_code = status_code
     return 'OK'
+
+
+@app.get("/stats")
+async def route_stats():
+    return {
+        'site_cache': site_cache.stats(),
+        'dns_cache': dns_cache.stats(),
+        'group_commit': committer.stats() if committer is not None else None,
+        'rejected': rejected_sink.stats(),
+        'rollups': rollup_refresher.stats(),
+    }
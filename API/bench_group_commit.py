@@ -0,0 +1,98 @@
+"""
+Benchmark of the observations write path: one commit per row (the default) versus
+group commit (INGEST_MODE=group).
+
+It needs a local MariaDB with the Machines database (see ServerSetup/MySQL), the
+rows are written with the fake logger 'bench-logger' and deleted at the end:
+
+    python bench_group_commit.py --rows 5000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import datetime
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api_station import engine, flush_rows, insert, parse_timestamp
+from ingest import GroupCommitter
+from models.Machines import MachineObs, MachineObsLatest
+
+
+loggerID = 'bench-logger'
+
+
+def make_rows(n, offset):
+    t0 = datetime.datetime(2020, 1, 1) + datetime.timedelta(days=offset)
+    return [
+        {
+            'loggerID': loggerID,
+            'timestamp': str(t0 + datetime.timedelta(minutes=i)),
+            'ta': 20.0,
+            'rh': 50.0,
+            'p': 950.0,
+            'U_Battery1': 4.1,
+            'signalStrength': 20,
+        }
+        for i in range(n)
+    ]
+
+
+async def cleanup():
+    async with AsyncSession(engine) as session:
+        await session.execute(sa.delete(MachineObs).where(MachineObs.loggerID == loggerID))
+        await session.execute(sa.delete(MachineObsLatest).where(MachineObsLatest.loggerID == loggerID))
+        await session.commit()
+
+
+async def run(rows, concurrency, submit):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def task(row):
+        async with semaphore:
+            await submit(row)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[task(row) for row in rows])
+    return time.perf_counter() - t0
+
+
+async def per_row(row):
+    async with AsyncSession(engine) as session:
+        await insert(session, MachineObs, received=sa.func.now(), **row)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--group-rows', type=int, default=100)
+    parser.add_argument('--group-delay', type=int, default=50, help='milliseconds')
+    args = parser.parse_args()
+
+    await cleanup()
+    try:
+        # One commit per row
+        elapsed = await run(make_rows(args.rows, 0), args.concurrency, per_row)
+        print(f'per-row commit: {args.rows / elapsed:8.0f} rows/s  ({args.rows} commits)')
+
+        # Group commit
+        committer = GroupCommitter(
+            flush_rows,
+            key=lambda row: (row['loggerID'], parse_timestamp(row['timestamp'])),
+            max_rows=args.group_rows,
+            max_delay=args.group_delay / 1000,
+        )
+        committer.start()
+        elapsed = await run(make_rows(args.rows, 100), args.concurrency, committer.submit)
+        await committer.stop()
+        print(f'group commit:   {args.rows / elapsed:8.0f} rows/s  ({committer.groups} commits)')
+    finally:
+        await cleanup()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
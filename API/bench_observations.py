@@ -0,0 +1,90 @@
+"""
+Benchmark of the conversion and serialization of the /observations/ rows: the
+former path (observation_row per row, the timestamp parsed back from a string,
+then FastAPI's jsonable_encoder and json.dumps) versus the bulk path
+(observation_rows and a JSONResponse). It does not need a database:
+
+    python bench_observations.py --rows 100000
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import random
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from api_wwcs import OBSERVATION_FIELDS, convert_timestamp, observation_rows
+
+
+Row = collections.namedtuple('Row', OBSERVATION_FIELDS)
+
+
+def make_rows(n):
+    # One row every 10 minutes, with some missing values (NULL or -999)
+    t0 = datetime.datetime(2024, 1, 1)
+    return [
+        Row(
+            loggerID='bench-logger',
+            p=round(random.uniform(850, 950), 1),
+            pr=random.choice([0.0, 0.0, 0.2, None]),
+            rh=random.choice([round(random.uniform(10, 100), 1)] * 9 + [-999.0]),
+            stationID='bench',
+            ta=round(random.uniform(-20, 40), 1),
+            timestamp=t0 + datetime.timedelta(minutes=10 * i),
+            ts10cm=None,
+        )
+        for i in range(n)
+    ]
+
+
+def old_row(row):
+    return {
+        "loggerID": row.loggerID,
+        "p": None if row.p is None else float(row.p),
+        "pr": None if row.pr is None else float(row.pr),
+        "rh": None if row.rh is None else float(row.rh),
+        "stationID": row.stationID,
+        "ta": None if row.ta is None else float(row.ta),
+        "timestamp": convert_timestamp(str(row.timestamp)),
+        "ts10cm": None if row.ts10cm is None else float(row.ts10cm)
+    }
+
+
+def before(rows):
+    return json.dumps(jsonable_encoder([old_row(row) for row in rows])).encode()
+
+
+def after(rows):
+    return JSONResponse(observation_rows(rows)).body
+
+
+def run(rows, serialize, repeat):
+    t0 = time.process_time()
+    for i in range(repeat):
+        body = serialize(rows)
+    return body, (time.process_time() - t0) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    # The former path relied on the CASE WHEN of the query for the -999 values
+    missing = ('p', 'pr', 'rh', 'ta', 'ts10cm')
+    sql_rows = [row._replace(**{name: None for name in missing if getattr(row, name) == -999}) for row in rows]
+    body0, cpu0 = run(sql_rows, before, args.repeat)
+    body1, cpu1 = run(rows, after, args.repeat)
+    assert json.loads(body0) == json.loads(body1)
+    print(f'before: {args.rows / cpu0:10.0f} rows/s')
+    print(f'after:  {args.rows / cpu1:10.0f} rows/s  ({cpu0 / cpu1:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
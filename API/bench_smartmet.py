@@ -0,0 +1,67 @@
+"""
+Benchmark of the /smartmet/ response shapes: the default one (15 label, unit,
+machineName dictionaries per row) versus the compact one (compact=true). It
+measures the payload size and the CPU time to build and serialize the response,
+as FastAPI does (jsonable_encoder and json.dumps for the default shape, json.dumps
+alone for the compact one). It does not need a database:
+
+    python bench_smartmet.py --rows 8760
+"""
+
+import argparse
+import datetime
+import json
+import random
+import time
+import types
+
+from fastapi.encoders import jsonable_encoder
+
+from api_wwcs import SMARTMET_VARIABLES, smartmet_compact, smartmet_row
+
+
+def make_rows(n):
+    t0 = datetime.datetime(2024, 1, 1)
+    return [
+        types.SimpleNamespace(
+            siteName='Bench Site',
+            latitude=38.5,
+            longitude=68.7,
+            timestamp=t0 + datetime.timedelta(hours=i),
+            **{column: round(random.uniform(0, 100), 2) for column, label, unit, machineName in SMARTMET_VARIABLES},
+        )
+        for i in range(n)
+    ]
+
+
+def default_shape(rows):
+    return json.dumps(jsonable_encoder([smartmet_row(row, 'bench') for row in rows])).encode()
+
+
+def compact_shape(rows):
+    return json.dumps(smartmet_compact(rows, 'bench')).encode()
+
+
+def run(rows, serialize, repeat):
+    t0 = time.process_time()
+    for i in range(repeat):
+        body = serialize(rows)
+    return len(body), (time.process_time() - t0) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=8760)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    size0, cpu0 = run(rows, default_shape, args.repeat)
+    size1, cpu1 = run(rows, compact_shape, args.repeat)
+    print(f'default: {size0 / 1e6:7.2f} MB  {cpu0 * 1e3:7.0f} ms CPU')
+    print(f'compact: {size1 / 1e6:7.2f} MB  {cpu1 * 1e3:7.0f} ms CPU  '
+          f'({size0 / size1:.1f}x smaller, {cpu0 / cpu1:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
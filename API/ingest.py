@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import datetime
+import hashlib
+import time
+import traceback
+
+
+class GroupCommitter:
+    """Write-behind queue that commits observations in groups.
+
+    Requests put their row in the queue and wait; a background task drains the
+    queue every max_rows rows or max_delay seconds (whatever comes first) and
+    writes the group with the given flush function, a single multi-row INSERT
+    and a single commit. The request is answered once its group is committed.
+
+    flush(rows) must return the set of keys (see key function) that were already
+    stored.
+    """
+
+    def __init__(self, flush, key, max_rows=100, max_delay=0.05):
+        self.flush = flush
+        self.key = key
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.task = None
+
+        # Counters
+        self.groups = 0
+        self.rows = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the background task, after flushing the queued rows."""
+        await self.queue.join()
+        self.task.cancel()
+
+    async def submit(self, row):
+        """Queue the row and wait until it is committed.
+
+        Returns True if the row was inserted, False if it was a duplicate.
+        Raises an exception if the row could not be inserted.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for the first row, then collect until the group is full or
+            # the delay expires
+            group = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(group) < self.max_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    group.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self.commit(group)
+            except Exception as exc:
+                # Nothing may stop the task, or the queued requests would wait
+                # for ever
+                traceback.print_exc()
+                for row, future in group:
+                    if not future.done():
+                        future.set_exception(exc)
+            finally:
+                for i in range(len(group)):
+                    self.queue.task_done()
+
+    async def commit(self, group):
+        # Rows repeated within the group are duplicates
+        rows = {}
+        duplicates = []
+        for row, future in group:
+            try:
+                key = self.key(row)
+            except Exception as exc:
+                # A bad row fails alone
+                if not future.done():
+                    future.set_exception(exc)
+                continue
+
+            if key in rows:
+                duplicates.append(future)
+            else:
+                rows[key] = row, future
+
+        try:
+            existing = await self.flush([row for row, future in rows.values()])
+        except Exception:
+            # A bad row makes the whole group fail, retry one by one
+            traceback.print_exc()
+            for key, (row, future) in rows.items():
+                try:
+                    existing = await self.flush([row])
+                except Exception as exc:
+                    if not future.done():
+                        future.set_exception(exc)
+                else:
+                    self.set_result(future, key not in existing)
+                    self.groups += 1
+                    self.rows += 1
+        else:
+            for key, (row, future) in rows.items():
+                self.set_result(future, key not in existing)
+            self.groups += 1
+            self.rows += len(rows)
+
+        for future in duplicates:
+            self.set_result(future, False)
+
+    @staticmethod
+    def set_result(future, result):
+        # The future is cancelled if the client went away
+        if not future.done():
+            future.set_result(result)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'groups': self.groups,
+            'rows': self.rows,
+        }
+
+
+class RejectedSink:
+    """Bounded buffer of rejected payloads, written in bulk by a background task.
+
+    Identical (domain, comment, data) tuples seen within window seconds are only
+    written once, and when the buffer is full new payloads are dropped; both are
+    counted. So a misbehaving station cannot flood the database.
+
+    flush(rows) writes a list of rows, dictionaries with the keys domain, comment,
+    received and data.
+    """
+
+    def __init__(self, flush, maxsize=1000, interval=1.0, window=60):
+        self.flush = flush
+        self.maxsize = maxsize
+        self.interval = interval
+        self.window = window
+        self.buffer = []
+        self.seen = {}  # hash of (domain, comment, data) -> time first seen
+        self.task = None
+
+        # Counters
+        self.reasons = collections.Counter()
+        self.duplicates = 0
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the background task, after writing the buffered rows."""
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.write()
+
+    def put(self, domain, comment, data):
+        self.reasons[comment] += 1
+
+        now = time.monotonic()
+        key = hashlib.sha1(f'{domain}\0{comment}\0{data}'.encode('utf-8')).digest()
+        seen = self.seen.get(key)
+        if seen is not None and now - seen < self.window:
+            self.duplicates += 1
+            return
+
+        if len(self.buffer) >= self.maxsize:
+            self.dropped += 1
+            return
+
+        self.seen[key] = now
+        self.buffer.append({
+            'domain': domain,
+            'comment': comment,
+            'received': datetime.datetime.now(),
+            'data': data,
+        })
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.write()
+
+    async def write(self):
+        # Forget the payloads seen before the window
+        now = time.monotonic()
+        self.seen = {key: seen for key, seen in self.seen.items() if now - seen < self.window}
+
+        rows, self.buffer = self.buffer, []
+        if rows:
+            try:
+                await self.flush(rows)
+            except asyncio.CancelledError:
+                # Stopped while writing, stop() writes them again
+                self.buffer[:0] = rows
+                raise
+            except Exception:
+                traceback.print_exc()
+                self.failed += len(rows)
+            else:
+                self.written += len(rows)
+
+    def stats(self):
+        return {
+            'buffered': len(self.buffer),
+            'written': self.written,
+            'duplicates': self.duplicates,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'reasons': dict(self.reasons),
+        }
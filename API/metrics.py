@@ -0,0 +1,168 @@
+"""
+Prometheus metrics shared by the FastAPI applications, exposed at /metrics.
+
+Scrape them directly from the application ports (127.0.0.1:5000/metrics and
+127.0.0.1:5052/metrics), Nginx does not expose them.
+"""
+
+import contextlib
+import time
+
+from fastapi import FastAPI, Request, Response
+import prometheus_client as prom
+import sqlalchemy as sa
+
+
+REQUESTS = prom.Counter(
+    'http_requests_total', 'HTTP requests',
+    ['app', 'method', 'route', 'status'],
+)
+LATENCY = prom.Histogram(
+    'http_request_duration_seconds', 'HTTP request latency',
+    ['app', 'method', 'route'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+POOL_WAIT = prom.Histogram(
+    'db_pool_checkout_seconds', 'Time to get a connection from the pool (includes connecting)',
+    ['app', 'pool'],
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 30),
+)
+POOL_CONNECT = prom.Histogram(
+    'db_pool_connect_seconds', 'Time to open a new database connection',
+    ['app', 'pool'],
+    buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 30),
+)
+POOL_CHECKOUTS = prom.Counter(
+    'db_pool_checkouts_total', 'Connections checked out from the pool',
+    ['app', 'pool'],
+)
+POOL_IN_USE = prom.Gauge(
+    'db_pool_connections_in_use', 'Connections checked out from the pool',
+    ['app', 'pool'],
+)
+POOL_SIZE = prom.Gauge(
+    'db_pool_connections', 'Connections held by the pool, in use or idle',
+    ['app', 'pool'],
+)
+POOL_CAPACITY = prom.Gauge(
+    'db_pool_capacity', 'Connections the pool may hold (size plus overflow); in use at capacity means requests wait',
+    ['app', 'pool'],
+)
+
+# Station API
+REJECTED = prom.Counter(
+    'station_rejected_total', 'Station payloads rejected, by reason',
+    ['reason'],
+)
+INSERTS = prom.Counter(
+    'station_inserts_total', 'Station observations by outcome (new, duplicate or failed)',
+    ['outcome'],
+)
+
+
+def instrument(app: FastAPI, name: str):
+    """Count and time every request, per route, and add the /metrics route."""
+
+    @app.middleware('http')
+    async def metrics_middleware(request: Request, call_next):
+        t0 = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # Use the route template (e.g. /areas/{area}/{date}) to keep the
+            # number of label values bounded
+            route = request.scope.get('route')
+            route = route.path if route is not None else 'unmatched'
+            method = request.method
+            REQUESTS.labels(name, method, route, status).inc()
+            LATENCY.labels(name, method, route).observe(time.perf_counter() - t0)
+
+    @app.get('/metrics', include_in_schema=False)
+    async def route_metrics():
+        return Response(prom.generate_latest(), media_type=prom.CONTENT_TYPE_LATEST)
+
+
+# The POOL_WAIT histogram of the instrumented engines
+pool_waits = {}
+
+
+def instrument_pool(engine, name: str, pool_name: str = 'default'):
+    """Track the connections of the engine pool with the pool events.
+
+    The listeners are on the engine, so they also apply to the new pool created
+    by engine.dispose(). The events fire once a connection is free, so the wait
+    for one is timed where it is taken, by checkout and checkout_session.
+    """
+    sync_engine = engine.sync_engine
+    pool_waits[sync_engine] = POOL_WAIT.labels(name, pool_name)
+    connect = POOL_CONNECT.labels(name, pool_name)
+    checkouts = POOL_CHECKOUTS.labels(name, pool_name)
+    in_use = POOL_IN_USE.labels(name, pool_name)
+
+    @sa.event.listens_for(sync_engine, 'do_connect')
+    def on_do_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info['connect_t0'] = time.perf_counter()
+
+    @sa.event.listens_for(sync_engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        t0 = connection_record.info.pop('connect_t0', None)
+        if t0 is not None:
+            connect.observe(time.perf_counter() - t0)
+
+    @sa.event.listens_for(sync_engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checkouts.inc()
+        in_use.inc()
+
+    @sa.event.listens_for(sync_engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        in_use.dec()
+
+    # Read from the current pool of the engine when scraped
+    def size():
+        pool = sync_engine.pool
+        return pool.checkedin() + pool.checkedout()
+
+    def capacity():
+        pool = sync_engine.pool
+        return pool.size() + max(pool._max_overflow, 0)
+
+    POOL_SIZE.labels(name, pool_name).set_function(size)
+    POOL_CAPACITY.labels(name, pool_name).set_function(capacity)
+
+
+def observe_wait(sync_engine, t0):
+    wait = pool_waits.get(sync_engine)
+    if wait is not None:
+        wait.observe(time.perf_counter() - t0)
+
+
+async def checkout(engine):
+    """await engine.connect(), recording the time waited for the connection."""
+    t0 = time.perf_counter()
+    conn = await engine.connect()
+    observe_wait(engine.sync_engine, t0)
+    return conn
+
+
+@contextlib.asynccontextmanager
+async def connect(engine):
+    """Like async with engine.connect(), recording the time waited (see checkout)."""
+    conn = await checkout(engine)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def checkout_session(session):
+    """Take the connection of the session now, recording the time waited. Does
+    nothing if the session already has one.
+    """
+    if not session.in_transaction():
+        t0 = time.perf_counter()
+        conn = await session.connection()
+        observe_wait(conn.engine.sync_engine, t0)
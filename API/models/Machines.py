@@ -1,6 +1,6 @@
 from typing import Optional
 
-from sqlalchemy import Column, DateTime, Float, String, Table, text
+from sqlalchemy import Column, DateTime, Double, Float, Integer, String, Table, text
 from sqlalchemy.dialects.mysql import DATETIME, LONGTEXT
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 import datetime
@@ -56,6 +56,43 @@ class MachineObs(Base):
     PM10: Mapped[Optional[float]] = mapped_column(Float)
 
 
+class MachineObsLatest(Base):
+    __tablename__ = 'MachineObsLatest'
+    __table_args__ = {'comment': 'Last observation of every logger'}
+
+    loggerID: Mapped[str] = mapped_column(String(50), primary_key=True)
+    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime)
+    received: Mapped[datetime.datetime] = mapped_column(DateTime, server_default=text("'1970-01-01 00:00:00'"))
+    ta: Mapped[Optional[float]] = mapped_column(Float)
+    rh: Mapped[Optional[float]] = mapped_column(Float)
+    logger_ta: Mapped[Optional[float]] = mapped_column(Float)
+    logger_rh: Mapped[Optional[float]] = mapped_column(Float)
+    p: Mapped[Optional[float]] = mapped_column(Float)
+    U_Battery: Mapped[Optional[float]] = mapped_column(Float)
+    U_Solar: Mapped[Optional[float]] = mapped_column(Float)
+    signalStrength: Mapped[Optional[float]] = mapped_column(Float)
+    Charge_Battery: Mapped[Optional[float]] = mapped_column(Float)
+    Temp_Battery: Mapped[Optional[float]] = mapped_column(Float)
+    Temp_HumiSens: Mapped[Optional[float]] = mapped_column(Float)
+    U_Battery1: Mapped[Optional[float]] = mapped_column(Float)
+    compass: Mapped[Optional[float]] = mapped_column(Float)
+    lightning_count: Mapped[Optional[float]] = mapped_column(Float)
+    lightning_dist: Mapped[Optional[float]] = mapped_column(Float)
+    pr: Mapped[Optional[float]] = mapped_column(Float)
+    rad: Mapped[Optional[float]] = mapped_column(Float)
+    tilt_x: Mapped[Optional[float]] = mapped_column(Float)
+    tilt_y: Mapped[Optional[float]] = mapped_column(Float)
+    ts10cm: Mapped[Optional[float]] = mapped_column(Float)
+    vapour_press: Mapped[Optional[float]] = mapped_column(Float)
+    wind_dir: Mapped[Optional[float]] = mapped_column(Float)
+    wind_gust: Mapped[Optional[float]] = mapped_column(Float)
+    wind_speed: Mapped[Optional[float]] = mapped_column(Float)
+    wind_speed_E: Mapped[Optional[float]] = mapped_column(Float)
+    wind_speed_N: Mapped[Optional[float]] = mapped_column(Float)
+    PM25: Mapped[Optional[float]] = mapped_column(Float)
+    PM10: Mapped[Optional[float]] = mapped_column(Float)
+
+
 t_MachineObsRejected = Table(
     'MachineObsRejected', Base.metadata,
     Column('domain', String(50), nullable=False),
@@ -121,3 +158,29 @@ t_v_machineobs = Table(
     Column('PM25', Float),
     Column('PM10', Float)
 )
+
+
+class MachineObsHourly(Base):
+    __tablename__ = 'MachineObsHourly'
+    __table_args__ = {'comment': 'Hourly aggregates of MachineObs'}
+
+    loggerID: Mapped[str] = mapped_column(String(50), primary_key=True)
+    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime, primary_key=True)
+    variable: Mapped[str] = mapped_column(String(30), primary_key=True)
+    n: Mapped[int] = mapped_column(Integer)
+    total: Mapped[float] = mapped_column(Double)
+    vmin: Mapped[float] = mapped_column(Float)
+    vmax: Mapped[float] = mapped_column(Float)
+
+
+class MachineObsDaily(Base):
+    __tablename__ = 'MachineObsDaily'
+    __table_args__ = {'comment': 'Daily aggregates of MachineObs'}
+
+    loggerID: Mapped[str] = mapped_column(String(50), primary_key=True)
+    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime, primary_key=True)
+    variable: Mapped[str] = mapped_column(String(30), primary_key=True)
+    n: Mapped[int] = mapped_column(Integer)
+    total: Mapped[float] = mapped_column(Double)
+    vmin: Mapped[float] = mapped_column(Float)
+    vmax: Mapped[float] = mapped_column(Float)
@@ -1,17 +1,22 @@
+import asyncio
 import collections
 import contextlib
 import datetime
 import hashlib
 import random
 import string
+import threading
 import time
+import types
 
 # Requirements
 import httpx
 import MySQLdb
 import pytest
 
+import api_station
 from common import USERNAME, PASSWORD
+from ingest import GroupCommitter, RejectedSink
 
 
 URL = 'http://localhost:8000'
@@ -48,6 +53,7 @@ def cleanup():
         'Machines.MachineAtSite',
         'Machines.Metadata',
         'Machines.MachineObs',
+        'Machines.MachineObsLatest',
     ]
     with get_cursor(commit=True) as cursor:
         for table in tables:
@@ -65,6 +71,20 @@ def count(cursor, table):
     n, = rows[0]
     return n
 
+def wait_count(table, expected, timeout=5):
+    """Rejected payloads are written asynchronously, wait until they are."""
+    t0 = time.time()
+    while True:
+        with get_cursor() as cursor:
+            n = count(cursor, table)
+        if n == expected or time.time() - t0 > timeout:
+            return n
+        time.sleep(0.2)
+
+def nonce():
+    """Identical rejected payloads are written only once in a while, make them unique."""
+    return ''.join(random.sample(string.hexdigits, 8))
+
 def get_last_reject(cursor):
     sql = 'SELECT * FROM Machines.MachineObsRejected ORDER BY received DESC LIMIT 1;'
     execute(cursor, sql)
@@ -291,16 +311,33 @@ def test_insert_dup(logger):
         assert count(cursor, 'Machines.MachineObsRejected') == m
 
 
+def test_insert_site_cache(logger):
+    def insert(timestamp):
+        key = f"{siteID}; {loggerID}; {timestamp}"
+        sign = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        json = {"sign": sign, "timestamp": timestamp, "loggerID": loggerID, "ta": 20.0}
+        response = httpx.post(f'{URL}/insert', json=json)
+        assert response.json() == 'New record inserted'
+
+    # The first insert after /register misses the cache, the second one hits it
+    stats = httpx.get(f'{URL}/stats').json()['site_cache']
+    insert("2023-04-21 23:00:00")
+    insert("2023-04-21 23:10:00")
+    new_stats = httpx.get(f'{URL}/stats').json()['site_cache']
+    assert new_stats['misses'] == stats['misses'] + 1
+    assert new_stats['hits'] == stats['hits'] + 1
+
+
 def test_insert_fail(logger):
     with get_cursor() as cursor:
         n = count(cursor, 'Machines.MachineObs')
         m = count(cursor, 'Machines.MachineObsRejected')
 
-    response = httpx.post(f'{URL}/insert', json={})
+    response = httpx.post(f'{URL}/insert', json={'nonce': nonce()})
     assert response.status_code == 200
+    assert wait_count('Machines.MachineObsRejected', m + 1) == m + 1
     with get_cursor() as cursor:
         assert count(cursor, 'Machines.MachineObs') == n
-        assert count(cursor, 'Machines.MachineObsRejected') == m + 1
 
         domain, received, data, comment = get_last_reject(cursor)
         assert comment == 'Incorrect JSON body'
@@ -311,18 +348,173 @@ def test_insert_fail(logger):
     '1970-01-01 00:00:01',
     '1995-03-23 12:15:00',
     '2099-12-21 19:33:33',
+    '2020-99-99 00:00:00',
 ])
 def test_insert_fail_timestamp(logger, timestamp):
     with get_cursor() as cursor:
         n = count(cursor, 'Machines.MachineObs')
         m = count(cursor, 'Machines.MachineObsRejected')
 
-    data = {'timestamp': timestamp, 'loggerID': loggerID, 'sign': 'fake-sign'}
+    data = {'timestamp': timestamp, 'loggerID': loggerID, 'sign': f'fake-sign-{nonce()}'}
     response = httpx.post(f'{URL}/insert', json=data)
     assert response.status_code == 200
+    assert wait_count('Machines.MachineObsRejected', m + 1) == m + 1
     with get_cursor() as cursor:
         assert count(cursor, 'Machines.MachineObs') == n
-        assert count(cursor, 'Machines.MachineObsRejected') == m + 1
 
         domain, received, data, comment = get_last_reject(cursor)
         assert comment == 'Invalid timestamp'
+
+
+def test_insert_batch(logger):
+    with get_cursor() as cursor:
+        n = count(cursor, 'Machines.MachineObs')
+        m = count(cursor, 'Machines.MachineObsRejected')
+
+    def record(timestamp, **kwargs):
+        key = f"{siteID}; {loggerID}; {timestamp}"
+        sign = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return {"sign": sign, "timestamp": timestamp, "loggerID": loggerID, **kwargs}
+
+    records = [
+        record("2023-04-21 23:00:00", ta=10.5, Temp_Battery1=27.0, git_version="FlashGIT"),
+        record("2023-04-21 23:10:00", ta=11.5),
+        record("2023-04-21 23:10:00", ta=11.5),                    # Duplicate within the batch
+        record("2023-04-21 23:20:00", nonce=nonce()) | {"sign": "fake-sign"},   # Incorrect hash
+        record("1995-03-23 12:15:00", nonce=nonce()),                           # Invalid timestamp
+        record("2023-04-21 23:30:00", nonce=nonce()) | {"loggerID": [loggerID]},  # Not a string
+    ]
+    response = httpx.post(f'{URL}/insert_batch', json=records)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    assert response.json() == {
+        'accepted': [0, 1],
+        'duplicates': [2],
+        'rejected': [
+            {'index': 3, 'reason': 'Incorrect hash'},
+            {'index': 4, 'reason': 'Invalid timestamp'},
+            {'index': 5, 'reason': 'Incorrect JSON body'},
+        ],
+    }
+
+    # Post again, now the valid records are duplicates
+    response = httpx.post(f'{URL}/insert_batch', json=records[:2])
+    assert response.status_code == 200
+    assert response.json() == {'accepted': [], 'duplicates': [0, 1], 'rejected': []}
+
+    # Verify inserted data
+    assert wait_count('Machines.MachineObsRejected', m + 3) == m + 3
+    with get_cursor() as cursor:
+        assert count(cursor, 'Machines.MachineObs') == n + 2
+
+        rows = select(cursor, 'Machines.MachineObs', ['ta', 'Temp_Battery'], loggerID=loggerID,
+                      order_by='timestamp')
+        assert [(row.ta, row.Temp_Battery) for row in rows] == [(10.5, 27.0), (11.5, None)]
+
+    # The snapshot has the last observation, older ones do not replace it
+    response = httpx.post(f'{URL}/insert_batch', json=[record("2023-04-21 22:50:00", ta=9.5)])
+    assert response.json()['accepted'] == [0]
+    with get_cursor() as cursor:
+        rows = select(cursor, 'Machines.MachineObsLatest', ['timestamp', 'ta', 'Temp_Battery'], loggerID=loggerID)
+        assert [(str(row.timestamp), row.ta, row.Temp_Battery) for row in rows] == [
+            ('2023-04-21 23:10:00', 11.5, None),
+        ]
+
+
+def test_insert_batch_fail(logger):
+    response = httpx.post(f'{URL}/insert_batch', json={})
+    assert response.status_code == 400
+
+
+def test_group_commit_bad_row():
+    # A row whose key cannot be computed fails alone, the task keeps running
+    async def flush(rows):
+        return set()
+
+    def key(row):
+        return (row['loggerID'], datetime.datetime.fromisoformat(row['timestamp']))
+
+    async def main():
+        committer = GroupCommitter(flush, key, max_delay=0.01)
+        committer.start()
+        results = await asyncio.wait_for(asyncio.gather(
+            committer.submit({'loggerID': 'a', 'timestamp': '2020-99-99 00:00:00'}),
+            committer.submit({'loggerID': 'a', 'timestamp': '2020-01-01 00:00:00'}),
+            return_exceptions=True,
+        ), 1)
+        assert isinstance(results[0], ValueError)
+        assert results[1] is True
+
+        # Later rows are still committed
+        assert await asyncio.wait_for(committer.submit({'loggerID': 'a', 'timestamp': '2020-01-01 00:10:00'}), 1)
+        await asyncio.wait_for(committer.stop(), 1)
+
+    asyncio.run(main())
+
+
+def test_rejected_sink_stop():
+    # The rows of a write interrupted by stop() are written by stop()
+    written = []
+    started = asyncio.Event()
+
+    async def flush(rows):
+        if not started.is_set():
+            started.set()
+            await asyncio.sleep(10)
+        written.extend(rows)
+
+    async def main():
+        sink = RejectedSink(flush, interval=0.01)
+        sink.start()
+        sink.put('example.org', 'Incorrect hash', '{}')
+        await asyncio.wait_for(started.wait(), 1)
+        sink.put('example.org', 'Invalid timestamp', '{}')
+        await asyncio.wait_for(sink.stop(), 1)
+        assert [row['comment'] for row in written] == ['Incorrect hash', 'Invalid timestamp']
+
+    asyncio.run(main())
+
+
+def test_get_domain(monkeypatch):
+    calls = collections.Counter()
+    release = threading.Event()
+
+    def gethostbyaddr(host):
+        calls[host] += 1
+        if host == '10.0.0.1':
+            return 'station.example.org'
+        if host == '10.0.0.2':
+            raise OSError('unknown host')
+        release.wait(5)  # A resolver that hangs
+        return 'slow.example.org'
+
+    monkeypatch.setattr(api_station, 'gethostbyaddr', gethostbyaddr)
+    monkeypatch.setattr(api_station, 'DNS_TIMEOUT', 0.1)
+    api_station.dns_cache.clear()
+
+    def request(host):
+        return types.SimpleNamespace(client=types.SimpleNamespace(host=host))
+
+    async def main():
+        # Resolved, then cached
+        assert await api_station.get_domain(request('10.0.0.1')) == 'station.example.org'
+        assert await api_station.get_domain(request('10.0.0.1')) == 'station.example.org'
+        assert calls['10.0.0.1'] == 1
+
+        # The lookup fails, the IP is used
+        assert await api_station.get_domain(request('10.0.0.2')) == '10.0.0.2'
+
+        # The lookup blocks: concurrent requests share a single lookup, and get
+        # the IP after the timeout without blocking the event loop
+        t0 = time.monotonic()
+        domains = await asyncio.gather(*[api_station.get_domain(request('10.0.0.3')) for i in range(5)])
+        assert domains == ['10.0.0.3'] * 5
+        assert time.monotonic() - t0 < 1
+        assert calls['10.0.0.3'] == 1
+        release.set()
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        api_station.dns_cache.clear()
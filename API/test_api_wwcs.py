@@ -1,14 +1,31 @@
+import asyncio
 import contextlib
+import csv
+import datetime
+import io
+import json
+import operator
+import types
 
 import MySQLdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
+import xarray as xr
 from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
 
-from api_wwcs import app
+import api_wwcs
+import archive
+import rollups
+from api_wwcs import CACHE_STAMP, app
 from common import USERNAME, PASSWORD
 
 siteID = "test-site-wwcs"
 loggerID = "test-logger-wwcs"
+loggerID2 = "test-logger-wwcs-2"
 
 
 @pytest.fixture
@@ -35,10 +52,19 @@ def get_cursor(commit=False):
 def cleanup():
     with get_cursor(commit=True) as cursor:
         cursor.execute(
-            "DELETE FROM Machines.MachineObs WHERE loggerID = %s", [loggerID]
+            "DELETE FROM Machines.MachineObs WHERE loggerID IN (%s, %s)", [loggerID, loggerID2]
         )
         cursor.execute(
-            "DELETE FROM Machines.MachineAtSite WHERE loggerID = %s", [loggerID]
+            "DELETE FROM Machines.MachineObsArchive WHERE loggerID = %s", [loggerID]
+        )
+        cursor.execute(
+            "DELETE FROM Machines.MachineObsHourly WHERE loggerID = %s", [loggerID]
+        )
+        cursor.execute(
+            "DELETE FROM Machines.MachineObsDaily WHERE loggerID = %s", [loggerID]
+        )
+        cursor.execute(
+            "DELETE FROM Machines.MachineAtSite WHERE loggerID IN (%s, %s)", [loggerID, loggerID2]
         )
         cursor.execute(
             "DELETE FROM SitesHumans.Sites WHERE siteID = %s", [siteID]
@@ -59,11 +85,11 @@ def setup_site_and_logger():
         )
 
 
-def insert_observation(timestamp, ta=20.0):
+def insert_observation(timestamp, ta=20.0, logger=loggerID, table="MachineObs"):
     with get_cursor(commit=True) as cursor:
         cursor.execute(
-            "INSERT INTO Machines.MachineObs (loggerID, timestamp, ta) VALUES (%s, %s, %s)",
-            [loggerID, timestamp, ta],
+            f"INSERT INTO Machines.{table} (loggerID, timestamp, ta) VALUES (%s, %s, %s)",
+            [logger, timestamp, ta],
         )
 
 
@@ -114,6 +140,14 @@ class TestObservationsDateParams:
         assert r.status_code == 400
         assert "Invalid date format" in r.json()["detail"]
 
+    def test_utc_offset(self, client):
+        r = client.get(
+            f"{self.endpoint}?{self.id_param}=nonexistent"
+            f"&start=2024-01-01T00:00:00%2B05:00&end=2024-01-02T00:00:00"
+        )
+        assert r.status_code == 400
+        assert "UTC offset" in r.json()["detail"]
+
     def test_start_after_end(self, client):
         r = client.get(
             f"{self.endpoint}?{self.id_param}=nonexistent"
@@ -147,6 +181,160 @@ class TestObservationsDateParams:
             assert air_temp is not None
             assert air_temp["value"] == 20.0
 
+    def test_logger_intervals(self, client, test_data):
+        # The logger of the site was replaced at 12:00, and its former logger
+        # moved elsewhere
+        with get_cursor(commit=True) as cursor:
+            cursor.execute(
+                "UPDATE Machines.MachineAtSite SET endDate = %s WHERE loggerID = %s",
+                ["2024-06-15 12:00:00", loggerID],
+            )
+            cursor.execute(
+                "INSERT INTO Machines.MachineAtSite (siteID, loggerID, startDate, endDate) "
+                "VALUES (%s, %s, %s, NULL)",
+                [siteID, loggerID2, "2024-06-15 12:00:01"],
+            )
+        insert_observation("2024-06-15 11:00:00", ta=10.0)
+        insert_observation("2024-06-15 13:00:00", ta=15.0)
+        insert_observation("2024-06-15 11:00:00", ta=25.0, logger=loggerID2)
+        insert_observation("2024-06-15 13:00:00", ta=20.0, logger=loggerID2)
+
+        r = client.get(
+            f"{self.endpoint}?{self.id_param}={siteID}"
+            f"&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00"
+        )
+        assert r.status_code == 200
+        data = r.json()
+        assert len(data) == 2
+        if self.endpoint == "/":
+            assert [(row["loggerID"], row["ta"]) for row in data] == [(loggerID2, 20.0), (loggerID, 10.0)]
+
+    def test_archive(self, client, test_data):
+        # Rows moved to the archive tier (partitions.py) are still served
+        insert_observation("2024-06-15 10:00:00", ta=10.0, table="MachineObsArchive")
+        insert_observation("2024-06-15 12:00:00", ta=20.0)
+
+        r = client.get(
+            f"{self.endpoint}?{self.id_param}={siteID}"
+            f"&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00"
+        )
+        assert r.status_code == 200
+        assert len(r.json()) == 2
+
+
+class TestColdArchive:
+
+    @pytest.fixture(autouse=True)
+    def archived(self, test_data, tmp_path, monkeypatch):
+        monkeypatch.setattr(archive, "ARCHIVE_DIR", tmp_path)
+        rows = [
+            {"timestamp": datetime.datetime(2024, 5, 31, 23, 50), "received": datetime.datetime(2024, 6, 1), "ta": 5.0},
+            {"timestamp": datetime.datetime(2024, 5, 31, 23, 55), "received": datetime.datetime(2024, 6, 1), "ta": -999},
+        ]
+        path = archive.month_dir("MachineObs", datetime.datetime(2024, 5, 1)) / f"loggerID={loggerID}" / "data.parquet"
+        archive.write_parquet(path, pa.Table.from_pylist(rows, schema=archive.OBS_FILE_SCHEMA), ["timestamp"])
+        (path.parent.parent / archive.SUCCESS).touch()
+        insert_observation("2024-06-01 00:10:00", ta=10.0)
+
+    def test_observations(self, client):
+        r = client.get(f"/?stationID={siteID}&start=2024-05-31T00:00:00&end=2024-06-02T00:00:00")
+        assert r.status_code == 200
+        assert [row["ta"] for row in r.json()] == [10.0, None, 5.0]
+
+        # Not read for requests after the archived months
+        r = client.get(f"/?stationID={siteID}&start=2024-06-01T00:00:00&end=2024-06-02T00:00:00")
+        assert [row["ta"] for row in r.json()] == [10.0]
+
+    def test_export(self, client):
+        r = client.get(
+            f"/smartmet/?siteID={siteID}&start=2024-05-31T00:00:00&end=2024-06-02T00:00:00&format=parquet"
+        )
+        assert r.status_code == 200
+        table = pq.read_table(io.BytesIO(r.content))
+        assert table.column("ta").to_pylist() == [10.0, None, 5.0]
+
+    def test_bulk(self, client):
+        r = client.get(f"/bulk?stationID={siteID}&start=2024-05-31T00:00:00&end=2024-06-02T00:00:00")
+        assert r.status_code == 200
+        assert [row["ta"] for row in r.json()] == [5.0, None, 10.0]
+
+    def test_airquality_history(self, client, monkeypatch):
+        monkeypatch.setattr(api_wwcs, "STATION_IDS", [loggerID])
+        # Since the archived month, whatever the date of the test
+        hours = (datetime.datetime.now() - datetime.datetime(2024, 5, 1)) // datetime.timedelta(hours=1)
+        r = client.get(f"/airquality/history?hours={hours}")
+        assert r.status_code == 200
+        assert [row["timestamp"] for row in r.json()][:3] == [
+            "2024-05-31T23:50:00", "2024-05-31T23:55:00", "2024-06-01T00:10:00",
+        ]
+
+
+def test_archive_boundary(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", tmp_path)
+    assert archive.archive_boundary() is None
+
+    # The month being exported is not used yet
+    for month in (datetime.datetime(2024, 5, 1), datetime.datetime(2024, 6, 1)):
+        archive.month_dir("MachineObs", month).mkdir(parents=True)
+    (archive.month_dir("MachineObs", datetime.datetime(2024, 5, 1)) / archive.SUCCESS).touch()
+    assert archive.archive_boundary() == datetime.datetime(2024, 6, 1)
+
+
+def test_merge_sorted():
+    async def chunks():
+        yield [(1, "a"), (3, "c")]
+        yield []
+        yield [(5, "e")]
+
+    async def merge():
+        return [chunk async for chunk in api_wwcs.merge_sorted(chunks(), rows, key=operator.itemgetter(0))]
+
+    rows = [(0, "x"), (2, "y"), (4, "z"), (6, "w")]
+    merged = asyncio.run(merge())
+    assert sum(merged, []) == sorted([(1, "a"), (3, "c"), (5, "e"), *rows])
+
+
+def test_observation_rows():
+    rows = [
+        types.SimpleNamespace(loggerID=loggerID, p=900.5, pr=None, rh=-999, stationID=siteID, ta=20,
+                              timestamp=datetime.datetime(2024, 6, 15, 10, 5), ts10cm=-1.5),
+        # Only -999 is missing, like in the queries and observation_row
+        types.SimpleNamespace(loggerID=loggerID, p=900.5, pr=0, rh=50, stationID=siteID, ta=-1000,
+                              timestamp=datetime.datetime(2024, 6, 15, 10, 10), ts10cm=None),
+    ]
+    assert api_wwcs.observation_rows(rows) == [{
+        "loggerID": loggerID, "p": 900.5, "pr": None, "rh": None, "stationID": siteID, "ta": 20.0,
+        "timestamp": "Sat, 15 Jun 2024 10:05:00 GMT+5", "ts10cm": -1.5,
+    }, {
+        "loggerID": loggerID, "p": 900.5, "pr": 0.0, "rh": 50.0, "stationID": siteID, "ta": -1000.0,
+        "timestamp": "Sat, 15 Jun 2024 10:10:00 GMT+5", "ts10cm": None,
+    }]
+    batch = api_wwcs.arrow_batch(rows, api_wwcs.OBSERVATION_SCHEMA)
+    assert batch.column("rh").to_pylist() == [None, 50.0]
+    assert batch.column("ta").to_pylist() == [20.0, -1000.0]
+
+
+class TestSmartmetCompact:
+
+    def test_compact(self, client, test_data):
+        insert_observation("2024-06-15 10:00:00", ta=10.0)
+        insert_observation("2024-06-15 12:00:00", ta=20.0)
+
+        url = f"/smartmet/?siteID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00"
+        rows = client.get(url).json()
+        r = client.get(url + "&compact=true")
+        assert r.status_code == 200
+        data = r.json()
+
+        # Same content as the default shape
+        assert data["variables"] == [
+            {key: x[key] for key in ("label", "unit", "machineName")} for x in rows[0]["data"]
+        ]
+        assert data["datetime"] == [row["datetime"] for row in rows]
+        assert data["data"] == [
+            [row["data"][i]["value"] for row in rows] for i in range(len(data["variables"]))
+        ]
+
 
 class TestSmartmetDateParams(TestObservationsDateParams):
     endpoint = "/smartmet/"
@@ -156,3 +344,200 @@ class TestSmartmetDateParams(TestObservationsDateParams):
 class TestEcmwfDateParams(TestObservationsDateParams):
     endpoint = "/ecmwf/"
     id_param = "siteID"
+
+
+class TestResponseCache:
+
+    def get_site_ids(self, client):
+        r = client.get("/stations/")
+        assert r.status_code == 200
+        return [site["siteID"] for site in r.json()]
+
+    def test_etag(self, client):
+        r = client.get("/stations/")
+        assert r.status_code == 200
+        etag = r.headers["etag"]
+
+        r = client.get("/stations/", headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.headers["etag"] == etag
+
+        r = client.get("/stations/", headers={"If-None-Match": '"other"'})
+        assert r.status_code == 200
+
+    def test_invalidate(self, client, test_data):
+        CACHE_STAMP.touch()
+        assert siteID in self.get_site_ids(client)
+
+        # Served from the cache
+        cleanup()
+        assert siteID in self.get_site_ids(client)
+
+        # The daily jobs touch the stamp file when done
+        CACHE_STAMP.touch()
+        assert siteID not in self.get_site_ids(client)
+
+
+class TestMap:
+
+    @pytest.fixture(autouse=True)
+    def raster(self, tmp_path, monkeypatch):
+        path = tmp_path / "raster_merged.nc"
+        time = pd.date_range("2024-06-15", periods=4, freq="6h")
+        lat = np.arange(37.0, 40.0, 0.5)
+        lon = np.arange(68.0, 72.0, 0.5)
+        data = np.arange(len(time) * len(lat) * len(lon), dtype="float32").reshape(len(time), len(lat), len(lon))
+        xr.Dataset(
+            {"IFS_T_mea": (("time", "lat", "lon"), data)},
+            coords={"time": time, "lat": lat, "lon": lon},
+        ).to_netcdf(path)
+        monkeypatch.setattr(api_wwcs, "map_raster", api_wwcs.MapRaster(path))
+
+    def test_point(self, client):
+        r = client.get("/map?lat=38.1&lon=69.9")
+        assert r.status_code == 200
+        data = r.json()
+        assert data["lat"]["data"] == 38.0
+        assert data["lon"]["data"] == 70.0
+        assert data["Tmean"]["data"] == [20.0, 68.0, 116.0, 164.0]
+
+    def test_points(self, client):
+        r = client.get("/map?lat=38.1,37.0&lon=69.9,68.0")
+        assert r.status_code == 200
+        data = r.json()
+        assert [point["Tmean"]["data"][0] for point in data] == [20.0, 0.0]
+
+    def test_file_replaced(self, client):
+        assert client.get("/map?lat=38.1&lon=69.9").status_code == 200
+        # While the cron job replaces the file, the loaded data is served
+        api_wwcs.map_raster.path.unlink()
+        r = client.get("/map?lat=38.1&lon=69.9")
+        assert r.status_code == 200
+        assert r.json()["Tmean"]["data"] == [20.0, 68.0, 116.0, 164.0]
+
+    def test_invalid(self, client):
+        assert client.get("/map?lat=38.1").status_code == 400
+        assert client.get("/map?lat=38.1,37&lon=69.9").status_code == 400
+
+
+class TestBulk:
+
+    def test_stations(self, client, test_data):
+        insert_observation("2024-06-15 10:00:00", ta=10.0)
+        insert_observation("2024-06-15 12:00:00", ta=20.0)
+
+        r = client.get(
+            f"/bulk?stationID={siteID},other-site"
+            f"&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00"
+        )
+        assert r.status_code == 200
+        assert [row["ta"] for row in r.json()] == [10.0, 20.0]
+        assert {row["stationID"] for row in r.json()} == {siteID}
+
+    def test_empty(self, client):
+        r = client.get("/bulk?district=no-such-district")
+        assert r.status_code == 200
+        assert r.json() == []
+
+    def test_invalid(self, client):
+        assert client.get("/bulk").status_code == 400
+        r = client.get(f"/bulk?stationID={siteID}&start=2024-01-01T00:00:00&end=2024-03-01T00:00:00")
+        assert r.status_code == 400
+
+
+class TestExport:
+
+    @pytest.fixture(autouse=True)
+    def observations(self, test_data):
+        insert_observation("2024-06-15 10:00:00", ta=10.0)
+        insert_observation("2024-06-15 12:00:00", ta=-999)
+
+    def test_ndjson(self, client):
+        r = client.get(
+            f"/?stationID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00&format=ndjson"
+        )
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        assert [row["ta"] for row in rows] == [None, 10.0]
+
+    def test_csv(self, client):
+        r = client.get(
+            f"/smartmet/?siteID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00&format=csv"
+        )
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith("text/csv")
+        rows = list(csv.DictReader(io.StringIO(r.text)))
+        assert [row["air_temperature"] for row in rows] == ["-999.0", "10.0"]
+
+    def test_arrow(self, client):
+        r = client.get(
+            f"/?stationID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00&format=arrow"
+        )
+        assert r.status_code == 200
+        table = pa.ipc.open_stream(r.content).read_all()
+        assert table.schema.field("ta").type == pa.float32()
+        assert table.column("ta").to_pylist() == [None, 10.0]
+
+    def test_parquet(self, client):
+        r = client.get(
+            f"/smartmet/?siteID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00&format=parquet"
+        )
+        assert r.status_code == 200
+        table = pq.read_table(io.BytesIO(r.content))
+        assert table.column("ta").to_pylist() == [None, 10.0]
+
+    def test_invalid(self, client):
+        assert client.get(f"/?stationID={siteID}&format=xml").status_code == 400
+
+
+def update_rollups(start, end):
+    async def update():
+        engine = create_async_engine(api_wwcs.DATABASE_URL_MACHINES)
+        async with engine.begin() as conn:
+            await rollups.update(conn, loggerID, start, end)
+        await engine.dispose()
+
+    asyncio.run(update())
+
+
+class TestAggregates:
+
+    @pytest.fixture(autouse=True)
+    def observations(self, test_data):
+        insert_observation("2024-06-15 10:00:00", ta=10.0)
+        insert_observation("2024-06-15 10:30:00", ta=20.0)
+        insert_observation("2024-06-15 11:00:00", ta=-999)
+        insert_observation("2024-06-15 12:00:00", ta=30.0)
+        update_rollups(datetime.datetime(2024, 6, 15), datetime.datetime(2024, 6, 16))
+
+    def test_hour(self, client):
+        r = client.get(
+            f"/aggregates?stationID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00&variables=ta"
+        )
+        assert r.status_code == 200
+        rows = r.json()
+        assert [row["n"] for row in rows] == [2, 1]
+        assert rows[0]["mean"] == 15.0
+        assert (rows[0]["min"], rows[0]["max"]) == (10.0, 20.0)
+
+    def test_day(self, client):
+        r = client.get(
+            f"/aggregates?stationID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00"
+            f"&variables=ta&resolution=day"
+        )
+        assert r.status_code == 200
+        [row] = r.json()
+        assert (row["n"], row["mean"], row["sum"]) == (3, 20.0, 60.0)
+
+    def test_idempotent(self, client):
+        update_rollups(datetime.datetime(2024, 6, 15, 10), datetime.datetime(2024, 6, 15, 11))
+        r = client.get(
+            f"/aggregates?stationID={siteID}&start=2024-06-15T00:00:00&end=2024-06-16T00:00:00"
+            f"&variables=ta&resolution=day"
+        )
+        assert r.json()[0]["n"] == 3
+
+    def test_invalid(self, client):
+        r = client.get(f"/aggregates?stationID={siteID}&start=2024-06-15&end=2024-06-16&resolution=week")
+        assert r.status_code == 400
@@ -0,0 +1,17 @@
+-- Snapshot of the last observation of every logger, kept up to date by the
+-- station API (api_station.py) on every insert. It has the same columns as
+-- MachineObs, in the same order: columns added to MachineObs must be added here
+-- too.
+CREATE TABLE Machines.MachineObsLatest LIKE Machines.MachineObs;
+ALTER TABLE Machines.MachineObsLatest DROP INDEX IF EXISTS idx_logger_timestamp;
+ALTER TABLE Machines.MachineObsLatest DROP PRIMARY KEY, ADD PRIMARY KEY (loggerID);
+ALTER TABLE Machines.MachineObsLatest COMMENT = 'Last observation of every logger';
+
+INSERT INTO Machines.MachineObsLatest
+SELECT dt.*
+FROM Machines.MachineObs dt
+INNER JOIN (
+    SELECT loggerID, MAX(timestamp) AS max_timestamp
+    FROM Machines.MachineObs
+    GROUP BY loggerID
+) dt_max ON dt.loggerID = dt_max.loggerID AND dt.timestamp = dt_max.max_timestamp;
@@ -0,0 +1,25 @@
+-- Hourly and daily aggregates of MachineObs, one row per logger, period and
+-- variable (long format). Missing values (NULL or -999) are not counted. The mean
+-- is total / n, for precipitation the total is the sum. timestamp is the start of
+-- the period. They are maintained by API/rollups.py.
+CREATE TABLE Machines.MachineObsHourly (
+  `loggerID` varchar(50) NOT NULL,
+  `timestamp` datetime NOT NULL,
+  `variable` varchar(30) NOT NULL,
+  `n` int(11) NOT NULL,
+  `total` double NOT NULL,
+  `vmin` float NOT NULL,
+  `vmax` float NOT NULL,
+  PRIMARY KEY (`loggerID`, `timestamp`, `variable`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci COMMENT='Hourly aggregates of MachineObs';
+
+CREATE TABLE Machines.MachineObsDaily (
+  `loggerID` varchar(50) NOT NULL,
+  `timestamp` datetime NOT NULL,
+  `variable` varchar(30) NOT NULL,
+  `n` int(11) NOT NULL,
+  `total` double NOT NULL,
+  `vmin` float NOT NULL,
+  `vmax` float NOT NULL,
+  PRIMARY KEY (`loggerID`, `timestamp`, `variable`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci COMMENT='Daily aggregates of MachineObs';
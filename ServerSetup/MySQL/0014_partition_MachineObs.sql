@@ -0,0 +1,198 @@
+-- Partition MachineObs by month, on timestamp. Queries bounded by timestamp only
+-- read the partitions of the range, and old months can be moved out cheaply.
+-- Future partitions are created, and old ones archived, by API/partitions.py
+-- (run it monthly from cron); pfuture only catches the rows beyond them.
+--
+-- This rebuilds the table, it takes a while on a large MachineObs.
+ALTER TABLE Machines.MachineObs
+PARTITION BY RANGE COLUMNS(timestamp) (
+    PARTITION pold VALUES LESS THAN ('2019-01-01'),
+    PARTITION p201901 VALUES LESS THAN ('2019-02-01'),
+    PARTITION p201902 VALUES LESS THAN ('2019-03-01'),
+    PARTITION p201903 VALUES LESS THAN ('2019-04-01'),
+    PARTITION p201904 VALUES LESS THAN ('2019-05-01'),
+    PARTITION p201905 VALUES LESS THAN ('2019-06-01'),
+    PARTITION p201906 VALUES LESS THAN ('2019-07-01'),
+    PARTITION p201907 VALUES LESS THAN ('2019-08-01'),
+    PARTITION p201908 VALUES LESS THAN ('2019-09-01'),
+    PARTITION p201909 VALUES LESS THAN ('2019-10-01'),
+    PARTITION p201910 VALUES LESS THAN ('2019-11-01'),
+    PARTITION p201911 VALUES LESS THAN ('2019-12-01'),
+    PARTITION p201912 VALUES LESS THAN ('2020-01-01'),
+    PARTITION p202001 VALUES LESS THAN ('2020-02-01'),
+    PARTITION p202002 VALUES LESS THAN ('2020-03-01'),
+    PARTITION p202003 VALUES LESS THAN ('2020-04-01'),
+    PARTITION p202004 VALUES LESS THAN ('2020-05-01'),
+    PARTITION p202005 VALUES LESS THAN ('2020-06-01'),
+    PARTITION p202006 VALUES LESS THAN ('2020-07-01'),
+    PARTITION p202007 VALUES LESS THAN ('2020-08-01'),
+    PARTITION p202008 VALUES LESS THAN ('2020-09-01'),
+    PARTITION p202009 VALUES LESS THAN ('2020-10-01'),
+    PARTITION p202010 VALUES LESS THAN ('2020-11-01'),
+    PARTITION p202011 VALUES LESS THAN ('2020-12-01'),
+    PARTITION p202012 VALUES LESS THAN ('2021-01-01'),
+    PARTITION p202101 VALUES LESS THAN ('2021-02-01'),
+    PARTITION p202102 VALUES LESS THAN ('2021-03-01'),
+    PARTITION p202103 VALUES LESS THAN ('2021-04-01'),
+    PARTITION p202104 VALUES LESS THAN ('2021-05-01'),
+    PARTITION p202105 VALUES LESS THAN ('2021-06-01'),
+    PARTITION p202106 VALUES LESS THAN ('2021-07-01'),
+    PARTITION p202107 VALUES LESS THAN ('2021-08-01'),
+    PARTITION p202108 VALUES LESS THAN ('2021-09-01'),
+    PARTITION p202109 VALUES LESS THAN ('2021-10-01'),
+    PARTITION p202110 VALUES LESS THAN ('2021-11-01'),
+    PARTITION p202111 VALUES LESS THAN ('2021-12-01'),
+    PARTITION p202112 VALUES LESS THAN ('2022-01-01'),
+    PARTITION p202201 VALUES LESS THAN ('2022-02-01'),
+    PARTITION p202202 VALUES LESS THAN ('2022-03-01'),
+    PARTITION p202203 VALUES LESS THAN ('2022-04-01'),
+    PARTITION p202204 VALUES LESS THAN ('2022-05-01'),
+    PARTITION p202205 VALUES LESS THAN ('2022-06-01'),
+    PARTITION p202206 VALUES LESS THAN ('2022-07-01'),
+    PARTITION p202207 VALUES LESS THAN ('2022-08-01'),
+    PARTITION p202208 VALUES LESS THAN ('2022-09-01'),
+    PARTITION p202209 VALUES LESS THAN ('2022-10-01'),
+    PARTITION p202210 VALUES LESS THAN ('2022-11-01'),
+    PARTITION p202211 VALUES LESS THAN ('2022-12-01'),
+    PARTITION p202212 VALUES LESS THAN ('2023-01-01'),
+    PARTITION p202301 VALUES LESS THAN ('2023-02-01'),
+    PARTITION p202302 VALUES LESS THAN ('2023-03-01'),
+    PARTITION p202303 VALUES LESS THAN ('2023-04-01'),
+    PARTITION p202304 VALUES LESS THAN ('2023-05-01'),
+    PARTITION p202305 VALUES LESS THAN ('2023-06-01'),
+    PARTITION p202306 VALUES LESS THAN ('2023-07-01'),
+    PARTITION p202307 VALUES LESS THAN ('2023-08-01'),
+    PARTITION p202308 VALUES LESS THAN ('2023-09-01'),
+    PARTITION p202309 VALUES LESS THAN ('2023-10-01'),
+    PARTITION p202310 VALUES LESS THAN ('2023-11-01'),
+    PARTITION p202311 VALUES LESS THAN ('2023-12-01'),
+    PARTITION p202312 VALUES LESS THAN ('2024-01-01'),
+    PARTITION p202401 VALUES LESS THAN ('2024-02-01'),
+    PARTITION p202402 VALUES LESS THAN ('2024-03-01'),
+    PARTITION p202403 VALUES LESS THAN ('2024-04-01'),
+    PARTITION p202404 VALUES LESS THAN ('2024-05-01'),
+    PARTITION p202405 VALUES LESS THAN ('2024-06-01'),
+    PARTITION p202406 VALUES LESS THAN ('2024-07-01'),
+    PARTITION p202407 VALUES LESS THAN ('2024-08-01'),
+    PARTITION p202408 VALUES LESS THAN ('2024-09-01'),
+    PARTITION p202409 VALUES LESS THAN ('2024-10-01'),
+    PARTITION p202410 VALUES LESS THAN ('2024-11-01'),
+    PARTITION p202411 VALUES LESS THAN ('2024-12-01'),
+    PARTITION p202412 VALUES LESS THAN ('2025-01-01'),
+    PARTITION p202501 VALUES LESS THAN ('2025-02-01'),
+    PARTITION p202502 VALUES LESS THAN ('2025-03-01'),
+    PARTITION p202503 VALUES LESS THAN ('2025-04-01'),
+    PARTITION p202504 VALUES LESS THAN ('2025-05-01'),
+    PARTITION p202505 VALUES LESS THAN ('2025-06-01'),
+    PARTITION p202506 VALUES LESS THAN ('2025-07-01'),
+    PARTITION p202507 VALUES LESS THAN ('2025-08-01'),
+    PARTITION p202508 VALUES LESS THAN ('2025-09-01'),
+    PARTITION p202509 VALUES LESS THAN ('2025-10-01'),
+    PARTITION p202510 VALUES LESS THAN ('2025-11-01'),
+    PARTITION p202511 VALUES LESS THAN ('2025-12-01'),
+    PARTITION p202512 VALUES LESS THAN ('2026-01-01'),
+    PARTITION p202601 VALUES LESS THAN ('2026-02-01'),
+    PARTITION p202602 VALUES LESS THAN ('2026-03-01'),
+    PARTITION p202603 VALUES LESS THAN ('2026-04-01'),
+    PARTITION p202604 VALUES LESS THAN ('2026-05-01'),
+    PARTITION p202605 VALUES LESS THAN ('2026-06-01'),
+    PARTITION p202606 VALUES LESS THAN ('2026-07-01'),
+    PARTITION p202607 VALUES LESS THAN ('2026-08-01'),
+    PARTITION p202608 VALUES LESS THAN ('2026-09-01'),
+    PARTITION p202609 VALUES LESS THAN ('2026-10-01'),
+    PARTITION p202610 VALUES LESS THAN ('2026-11-01'),
+    PARTITION p202611 VALUES LESS THAN ('2026-12-01'),
+    PARTITION p202612 VALUES LESS THAN ('2027-01-01'),
+    PARTITION pfuture VALUES LESS THAN (MAXVALUE)
+);
+
+-- Archive tier: raw observations of the months moved out of MachineObs, with
+-- compressed pages. Same columns and keys as MachineObs, the API reads both.
+CREATE TABLE Machines.MachineObsArchive LIKE Machines.MachineObs;
+ALTER TABLE Machines.MachineObsArchive REMOVE PARTITIONING;
+ALTER TABLE Machines.MachineObsArchive PAGE_COMPRESSED=1;
+ALTER TABLE Machines.MachineObsArchive COMMENT = 'Data measured by the machines, archived months';
+
+-- v_machineobs reads both tiers, so the readers of the view (the R services,
+-- /observations/bulk) keep the archived months. The join is in every branch, so
+-- a filter on siteID is applied to each table before the union.
+DROP VIEW IF EXISTS Machines.v_machineobs;
+
+CREATE VIEW Machines.v_machineobs AS
+SELECT
+    D.siteID,
+    S.loggerID,
+    S.timestamp,
+    S.received,
+    S.ta,
+    S.rh,
+    S.logger_ta,
+    S.logger_rh,
+    S.p,
+    S.U_Battery,
+    S.U_Solar,
+    S.signalStrength,
+    S.Charge_Battery,
+    S.Temp_Battery,
+    S.Temp_HumiSens,
+    S.U_Battery1,
+    S.compass,
+    S.lightning_count,
+    S.lightning_dist,
+    S.pr,
+    S.rad,
+    S.tilt_x,
+    S.tilt_y,
+    S.ts10cm,
+    S.vapour_press,
+    S.wind_dir,
+    S.wind_gust,
+    S.wind_speed,
+    S.wind_speed_E,
+    S.wind_speed_N,
+    S.PM25,
+    S.PM10
+FROM Machines.MachineObs S
+JOIN Machines.MachineAtSite D
+    ON D.loggerID = S.loggerID
+    AND S.timestamp >= COALESCE(D.startDate, CURRENT_TIMESTAMP())
+    AND S.timestamp <= COALESCE(D.endDate, CURRENT_TIMESTAMP())
+UNION ALL
+SELECT
+    D.siteID,
+    S.loggerID,
+    S.timestamp,
+    S.received,
+    S.ta,
+    S.rh,
+    S.logger_ta,
+    S.logger_rh,
+    S.p,
+    S.U_Battery,
+    S.U_Solar,
+    S.signalStrength,
+    S.Charge_Battery,
+    S.Temp_Battery,
+    S.Temp_HumiSens,
+    S.U_Battery1,
+    S.compass,
+    S.lightning_count,
+    S.lightning_dist,
+    S.pr,
+    S.rad,
+    S.tilt_x,
+    S.tilt_y,
+    S.ts10cm,
+    S.vapour_press,
+    S.wind_dir,
+    S.wind_gust,
+    S.wind_speed,
+    S.wind_speed_E,
+    S.wind_speed_N,
+    S.PM25,
+    S.PM10
+FROM Machines.MachineObsArchive S
+JOIN Machines.MachineAtSite D
+    ON D.loggerID = S.loggerID
+    AND S.timestamp >= COALESCE(D.startDate, CURRENT_TIMESTAMP())
+    AND S.timestamp <= COALESCE(D.endDate, CURRENT_TIMESTAMP());
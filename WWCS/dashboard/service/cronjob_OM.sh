@@ -36,3 +36,6 @@ echo "=== PROCESS WEATHER PICTOGRAMS FROM FORECASTS ==="
 R CMD BATCH --no-save ${my_dir}/forecasts/process_pictos.R  ${my_dir}/cronout/pictos.out
 
 R CMD BATCH --no-save ${my_dir}/forecasts/prepare_api_data.R  ${my_dir}/cronout/api.out
+
+# touch the stamp file to invalidate the response cache of the API
+${my_dir}/../../touch_cache_stamp.sh
@@ -29,3 +29,6 @@ echo "=== PROCESS WEATHER PICTOGRAMS FROM FORECASTS ==="
 R CMD BATCH --no-save forecasts/process_pictos.R  cronout/pictos.out
 
 R CMD BATCH --no-save forecasts/prepare_api_data.R  cronout/api.out
+
+# touch the stamp file to invalidate the response cache of the API
+/home/wwcs/wwcs/WWCS/touch_cache_stamp.sh
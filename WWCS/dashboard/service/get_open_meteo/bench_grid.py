@@ -0,0 +1,80 @@
+"""
+Wall-clock benchmark of the grid download of get_open_meteo_grid.py, against the
+local stub of the Open-Meteo ensemble API of stub_api.py (no network, no API
+calls used). The grid is the area of WWCS/config_tajikistan.yaml (or --config),
+downloaded with 1 worker, then with more:
+
+    python bench_grid.py --workers 1 4 8 --latency 2 --fail-rate 0.05
+    python bench_grid.py --workers 8 --config config_uzbekistan.yaml --calls-per-minute 100000
+
+With the budget of the free API (600 calls per minute, every location counts)
+the ~700 points of the grid take more than a minute whatever the workers, the
+rate limiter only avoids the 429s. With the budget of the commercial API
+(--calls-per-minute 100000) 8 workers are ~5x faster than 1.
+"""
+
+import argparse
+import datetime
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import numpy as np
+import yaml
+
+import client
+import get_open_meteo_grid as grid
+from stub_api import StubServer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--latency', type=float, default=2, help='seconds per request')
+    parser.add_argument('--latency-per-point', type=float, default=0.01, help='seconds per location')
+    parser.add_argument('--fail-rate', type=float, default=0.05)
+    parser.add_argument('--calls-per-minute', type=int, default=grid.CALLS_PER_MINUTE)
+    parser.add_argument('--forecast-days', type=int, default=10)
+    parser.add_argument('--config', default='config_tajikistan.yaml', help='area of WWCS/config_*.yaml')
+    args = parser.parse_args()
+
+    with (client.ROOT_PATH / args.config).open() as file:
+        config = yaml.safe_load(file)
+    lats = np.arange(np.floor(config['minlat'] * 4) / 4, np.ceil(config['maxlat'] * 4) / 4, .25)
+    lons = np.arange(np.floor(config['minlon'] * 4) / 4, np.ceil(config['maxlon'] * 4) / 4, .25)
+    chunks = grid.chunk_points(lats, lons)
+    print(f'{args.config}: {len(lats)} x {len(lons)} points, {len(chunks)} chunks')
+
+    server = StubServer(args.latency, args.latency_per_point, args.fail_rate, args.calls_per_minute)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The clients are created in the download threads, after this
+    os.environ['OPENMETEO_ENSEMBLE_URL'] = server.url
+    client.CACHE_PATH = pathlib.Path(tempfile.mkdtemp()) / 'cache.sqlite'
+    grid.RETRY_DELAY = 1
+
+    results = []
+    for i, workers in enumerate(args.workers):
+        # Wait for the budget of the previous run to be free again
+        if i > 0:
+            time.sleep(60)
+
+        server.counters.clear()
+        # Another date for every run, so nothing comes from the HTTP cache (a
+        # temporary one)
+        date = datetime.date(2024, 1, 1) + datetime.timedelta(days=i)
+        t0 = time.perf_counter()
+        bucket = grid.rate_limiter(args.calls_per_minute)
+        times, mean, std = grid.download_grid(lats, lons, date, args.forecast_days, bucket, workers)
+        elapsed = time.perf_counter() - t0
+        assert not np.isnan(mean).any() and not np.isnan(std).any()
+        results.append((workers, elapsed, dict(server.counters)))
+
+    server.shutdown()
+    for workers, elapsed, counters in results:
+        print(f'{workers:2} workers: {elapsed:6.1f} s  ({results[0][1] / elapsed:.1f}x)  {counters}')
+
+
+if __name__ == '__main__':
+    main()
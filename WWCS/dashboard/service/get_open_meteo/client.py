@@ -1,4 +1,8 @@
+import collections
+import datetime
 import os
+import pathlib
+import threading
 
 import mysql.connector
 import numpy as np
@@ -16,6 +20,22 @@ from common import USERNAME, PASSWORD, ROOT_DIR
 ROOT_PATH = ROOT_DIR / "WWCS"
 DATA_PATH = ROOT_PATH / "dashboard" / "ifsdata"
 
+# HTTP cache shared by the scripts and their reruns
+CACHE_PATH = pathlib.Path(os.environ.get('OPENMETEO_CACHE', ROOT_PATH / "dashboard" / "openmeteo_cache.sqlite"))
+CACHE_MAX_SIZE = int(os.environ.get('OPENMETEO_CACHE_MB', 1024)) * 1_000_000
+
+# The ECMWF ensemble runs every 6 hours (00, 06, 12 and 18 UTC), the responses
+# that include hours not yet past are cached until the next run
+MODEL_RUN_HOURS = 6
+
+# Size of a request, in locations x variables x forecast days: the chunks of
+# get_open_meteo_grid.py (100 locations, 1 variable, 10 days) are known to work
+MAX_REQUEST_SIZE = 1000
+
+# Responses from the cache and from the API, of all the clients
+CACHE_STATS = collections.Counter()
+cache_stats_lock = threading.Lock()
+
 
 def enum_code_to_name(enum_cls, code: int):
     # enum members are stored as class attributes; reverse-lookup by value
@@ -40,89 +60,235 @@ def get_sites():
             cursor.execute("SELECT siteID, latitude, longitude FROM Sites WHERE forecast=1")
             return cursor.fetchall()
 
+def max_locations(variables: int, forecast_days: int) -> int:
+    """Locations per request for the variables and forecast days, within MAX_REQUEST_SIZE."""
+    return max(1, MAX_REQUEST_SIZE // (variables * forecast_days))
+
+def complete_response(response):
+    """
+    False if the stream of the response was cut by an error: the API sends them
+    with status 200, they must not be cached or the retries would get them again.
+    """
+    data = response.content or b''
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + 10] == b'Unexpected':
+            return False
+        pos += int.from_bytes(data[pos:pos + 4], byteorder='little') + 4
+    return True
+
+def cache_expiry(params: dict, now: datetime.datetime = None):
+    """
+    Until when the response to params can be cached: for ever if the requested
+    period ended before yesterday (the past hours are not revised by later
+    runs), else until the next model run. The periods that reach into the future
+    come from the last run, whatever the start date.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    end_date = datetime.date.fromisoformat(str(params['end_date']))
+    if end_date < now.date() - datetime.timedelta(days=1):
+        return requests_cache.NEVER_EXPIRE
+
+    run = now.replace(hour=now.hour - now.hour % MODEL_RUN_HOURS, minute=0, second=0, microsecond=0)
+    return run + datetime.timedelta(hours=MODEL_RUN_HOURS)
+
+class CountingSession(requests_cache.CachedSession):
+    """Cached session that counts the responses from the cache and from the API."""
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        with cache_stats_lock:
+            CACHE_STATS['hits' if getattr(response, 'from_cache', False) else 'misses'] += 1
+        return response
+
+def log_cache_stats():
+    hits, misses = CACHE_STATS['hits'], CACHE_STATS['misses']
+    rate = f"{hits / (hits + misses):.0%}" if hits + misses else "-"
+    size = CACHE_PATH.stat().st_size / 1_000_000 if CACHE_PATH.exists() else 0
+    print(f"HTTP cache: {hits} hits, {misses} misses, hit rate {rate}, {size:.0f} MB")
+
+def evict_cache(max_size: int = CACHE_MAX_SIZE):
+    """
+    Delete the expired responses, then the oldest ones until the cache file is
+    under max_size bytes.
+    """
+    cache = requests_cache.SQLiteCache(CACHE_PATH)
+    cache.delete(expired=True)
+
+    responses = cache.responses
+    while responses.size() > max_size and len(responses):
+        # Rows are replaced when a response is saved again, so the rowid follows
+        # the time of saving
+        with responses.connection(commit=True) as con:
+            con.execute(
+                f"DELETE FROM {responses.table_name} WHERE rowid IN "
+                f"(SELECT rowid FROM {responses.table_name} ORDER BY rowid LIMIT ?)",
+                (max(1, len(responses) // 10),),
+            )
+        responses.vacuum()
+
 class Client:
 
     def __init__(self):
-        cache_session = requests_cache.CachedSession('.cache', expire_after=3600, backend='memory')
+        # The API key is not part of the cache key
+        cache_session = CountingSession(str(CACHE_PATH), backend='sqlite', ignored_parameters=['apikey'],
+                                        filter_fn=complete_response)
         retry_session = retry_requests.retry(cache_session, retries=5, backoff_factor=0.2)
         self.client = openmeteo_requests.Client(session=retry_session)
 
         # Commercial API with key or free public API
         self.api_key = os.getenv('OPENMETEO_API_KEY')
 
-    def _ensemble_response_to_dataframe(
-        self,
-        response,
-        output_config: dict = None
-    ):
+        # Another server, e.g. the stub of stub_api.py
+        self.ensemble_url = os.getenv('OPENMETEO_ENSEMBLE_URL')
+
+    def _dispatch_table(self, hourly, output_config: dict):
         """
-        Convert ensemble response to DataFrame with configurable outputs.
+        The indices of the variables (the members) of each output key in hourly.
+        A variable goes to the first key whose variable and filter match.
         """
-        hourly = response.Hourly()
+        by_variable = collections.defaultdict(list)
+        for key, config in output_config.items():
+            by_variable[config['variable']].append((key, config.get('filter')))
+
+        table = {key: [] for key in output_config}
+        for i in range(hourly.VariablesLength()):
+            var = hourly.Variables(i)
+            for key, filter_fn in by_variable.get(var.Variable(), []):
+                if filter_fn is None or filter_fn(var):
+                    table[key].append(i)
+                    break  # One variable matches one key
+
+        return table
+
+    def ensemble_arrays(self, responses, output_config: dict):
+        """
+        Aggregate the members of the responses, one per location of a request.
+        Returns the times and a dictionary of arrays: latitude and longitude (one
+        value per location), and f"{key}_{aggregation}" of shape (location, time).
+        """
+        first = responses[0].Hourly()
+        start, end, interval = first.Time(), first.TimeEnd(), first.Interval()
 
         # Time extraction - make timezone-naive for NetCDF compatibility
         time_values = pd.date_range(
-            start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-            end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=hourly.Interval()),
+            start=pd.to_datetime(start, unit="s", utc=True),
+            end=pd.to_datetime(end, unit="s", utc=True),
+            freq=pd.Timedelta(seconds=interval),
             inclusive="left"
         ).tz_convert(None)  # <-- Remove timezone
 
-        # Group variables by output key
-        data_arrays = {key: [] for key in output_config}
-
-        for i in range(hourly.VariablesLength()):
-            var = hourly.Variables(i)
+        # The variables come in the same order for all the locations of a request,
+        # the table is compiled from the first one
+        table = self._dispatch_table(first, output_config)
+        for key, indices in table.items():
+            if not indices:
+                raise ValueError(f"No variable for {key} in the response")
 
-            for key, config in output_config.items():
-                # Check variable type
-                if var.Variable() != config['variable']:
-                    continue
-
-                # Apply filter if provided
-                if 'filter' in config and not config['filter'](var):
-                    continue
+        buffers = {
+            key: np.empty((len(responses), len(indices), len(time_values)), dtype="float32")
+            for key, indices in table.items()
+        }
+        for i, response in enumerate(responses):
+            hourly = response.Hourly()
+            if (hourly.Time(), hourly.TimeEnd(), hourly.Interval()) != (start, end, interval):
+                raise ValueError("The locations of a request have different times")
 
-                data_arrays[key].append(var.ValuesAsNumpy())
-                break  # One variable matches one key
+            for key, indices in table.items():
+                for member, j in enumerate(indices):
+                    buffers[key][i, member] = hourly.Variables(j).ValuesAsNumpy()
 
-        # Build DataFrame
         result_data = {
-            'time': time_values,
-            'latitude': response.Latitude(),
-            'longitude': response.Longitude(),
+            'latitude': np.array([response.Latitude() for response in responses]),
+            'longitude': np.array([response.Longitude() for response in responses]),
         }
 
         for key, config in output_config.items():
-            members = np.stack(data_arrays[key])  # Shape: (members, time)
+            members = buffers[key]  # Shape: (location, members, time)
+            aggregations = config['aggregations']
+
+            # The mean is computed once, for the mean and the std
+            if 'mean' in aggregations or 'std' in aggregations:
+                mean = members.mean(axis=1)
 
-            for agg in config['aggregations']:
-                if isinstance(agg, str):
+            for agg in aggregations:
+                if agg == 'mean':
+                    result_data[f"{key}_mean"] = mean
+
+                elif agg == 'std':
+                    # As np.std, from the mean above
+                    deviations = members - mean[:, np.newaxis]
+                    np.square(deviations, out=deviations)
+                    result_data[f"{key}_std"] = np.sqrt(deviations.mean(axis=1))
+
+                elif isinstance(agg, str):
                     # Standard aggregation
                     f = getattr(np, agg)
-                    result_data[f"{key}_{agg}"] = f(members, axis=0)
+                    result_data[f"{key}_{agg}"] = f(members, axis=1)
 
                 elif isinstance(agg, tuple):
-                    # Custom aggregation: (name, function)
+                    # Custom aggregation: (name, function of a (members, time) array)
                     agg_name, agg_func = agg
-                    result_data[f"{key}_{agg_name}"] = agg_func(members)
+                    result_data[f"{key}_{agg_name}"] = np.stack([agg_func(x) for x in members])
                 else:
                     raise TypeError()
 
+        return time_values, result_data
+
+    def _ensemble_responses_to_dataframe(self, responses, output_config: dict):
+        """
+        Convert ensemble responses to one DataFrame with configurable outputs,
+        the locations one after the other.
+        """
+        time_values, arrays = self.ensemble_arrays(responses, output_config)
+        n = len(time_values)
+
+        result_data = {
+            'time': np.tile(time_values.values, len(responses)),
+            'latitude': np.repeat(arrays.pop('latitude'), n),
+            'longitude': np.repeat(arrays.pop('longitude'), n),
+        }
+        for name, values in arrays.items():
+            result_data[name] = values.reshape(-1)
+
         return pd.DataFrame(result_data)
 
+    def _ensemble_response_to_dataframe(
+        self,
+        response,
+        output_config: dict = None
+    ):
+        """
+        Convert ensemble response to DataFrame with configurable outputs.
+        """
+        return self._ensemble_responses_to_dataframe([response], output_config)
+
     def ensemble(self, params: dict):
         url = "https://ensemble-api.open-meteo.com/v1/ensemble"
         if self.api_key:
             params["apikey"] = self.api_key
             url = "https://customer-ensemble-api.open-meteo.com/v1/ensemble"
-        return self.client.weather_api(url, params=params)
+        if self.ensemble_url:
+            url = self.ensemble_url
+        return self.client.weather_api(url, params=params, expire_after=cache_expiry(params))
+
+    def ensemble_dfs(self, params: dict, aggrs: dict):
+        """One DataFrame per location, in the order of the locations of params."""
+        time_values, arrays = self.ensemble_arrays(self.ensemble(params), aggrs)
+        latitudes, longitudes = arrays.pop('latitude'), arrays.pop('longitude')
+        return [
+            pd.DataFrame({
+                'time': time_values,
+                'latitude': latitude,
+                'longitude': longitude,
+                **{name: values[i] for name, values in arrays.items()},
+            })
+            for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes))
+        ]
 
     def ensemble_df(self, params: dict, aggrs: dict):
         responses = self.ensemble(params)
-        dfs = [self._ensemble_response_to_dataframe(r, aggrs) for r in responses]
-        result = pd.concat(dfs, ignore_index=True)
-        return result
+        return self._ensemble_responses_to_dataframe(responses, aggrs)
 
 
 #    def _response_to_dataframe(self, response):
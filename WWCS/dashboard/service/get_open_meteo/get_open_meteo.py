@@ -1,3 +1,4 @@
+import argparse
 from datetime import date, datetime, timedelta
 
 import netCDF4
@@ -136,6 +137,12 @@ def dataframe_to_netcdf(df: pd.DataFrame, filename: str, ref_date: date, lat: fl
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int,
+                        help='sites per request (1 for a request per site), by default as many as'
+                             ' client.MAX_REQUEST_SIZE allows for the variables and forecast days')
+    args = parser.parse_args()
+
     train_period = 30
     forecast_days = 10
 
@@ -186,9 +193,14 @@ if __name__ == '__main__':
     }
     hourly = sorted(output_config.keys())
 
+    # Sites per request. The API answers with one response per location, and
+    # every location counts as one call of the budget.
+    batch_size = args.batch_size or client.max_locations(len(hourly), forecast_days)
+
     forecast_delta = timedelta(days=forecast_days - 1)
     for date in dates:
         date_str = date.strftime("%Y-%m-%d")
+        todo = []
         for site_id, lat, lon in sites:
 
             # TODO Remove this test
@@ -200,11 +212,16 @@ if __name__ == '__main__':
                 print(f"Skipping {filename}, already exists")
                 continue
 
-            # Use ensemble API
-            df = om_client.ensemble_df(
+            todo.append((site_id, lat, lon, filename))
+
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i:i + batch_size]
+
+            # Use ensemble API, one DataFrame per site
+            dfs = om_client.ensemble_dfs(
                 {
-                    'latitude': lat,
-                    'longitude': lon,
+                    'latitude': [float(lat) for site_id, lat, lon, filename in batch],
+                    'longitude': [float(lon) for site_id, lat, lon, filename in batch],
                     'start_date': date_str,
                     'end_date': (date + forecast_delta).strftime('%Y-%m-%d'),
                     'hourly': hourly,
@@ -212,9 +229,15 @@ if __name__ == '__main__':
                 },
                 output_config,
             )
+            if len(dfs) != len(batch):
+                raise ValueError(f"{len(dfs)} responses for {len(batch)} sites")
+
+            for (site_id, lat, lon, filename), df in zip(batch, dfs):
+                # Drop lat/lon columns since they're constant per file
+                df = df.drop(columns=['latitude', 'longitude'])
 
-            # Drop lat/lon columns since they're constant per file
-            df = df.drop(columns=['latitude', 'longitude'])
+                # Pass lat/lon explicitly to netcdf function
+                dataframe_to_netcdf(df, str(filename), date, lat, lon)
 
-            # Pass lat/lon explicitly to netcdf function
-            dataframe_to_netcdf(df, str(filename), date, lat, lon)
+    client.evict_cache()
+    client.log_cache_stats()
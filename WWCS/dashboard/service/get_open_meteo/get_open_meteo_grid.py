@@ -1,5 +1,9 @@
+import concurrent.futures
 import datetime
+import os
 import re
+import threading
+import time
 from typing import List, Tuple
 
 import numpy as np
@@ -9,10 +13,74 @@ from openmeteo_sdk.Variable import Variable
 
 import client
 
-om_client = client.Client()
-
 MAX_POINTS = 100
 
+# Chunks downloaded at the same time
+MAX_WORKERS = int(os.environ.get('OPENMETEO_WORKERS', 4))
+
+# Open-Meteo counts every location of a request as one call, the free API allows
+# 600 calls per minute
+CALLS_PER_MINUTE = int(os.environ.get('OPENMETEO_CALLS_PER_MINUTE', 600))
+
+# A chunk that fails (after the HTTP retries of the client) is downloaded again,
+# up to CHUNK_RETRIES times, waiting RETRY_DELAY seconds, then twice as long...
+CHUNK_RETRIES = 3
+RETRY_DELAY = 10
+
+# Ensemble mean and spread of the temperature at 2 m
+AGGRS = {
+    'temperature_2m': {
+        'variable': Variable.temperature,
+        'filter': lambda v: v.Altitude() == 2,
+        'aggregations': ['mean', 'std'],
+    }
+}
+
+# One client per thread, the requests sessions are not thread safe
+local = threading.local()
+
+
+def get_client():
+    if not hasattr(local, 'client'):
+        local.client = client.Client()
+    return local.client
+
+
+class TokenBucket:
+    """
+    Rate limiter shared by the download threads: up to capacity tokens, refilled
+    at rate tokens per second. acquire(n) blocks until n tokens are available.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n: float):
+        n = min(n, self.capacity)
+        # The lock is held while waiting, so the threads are served in turn
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                time.sleep((n - self.tokens) / self.rate)
+
+
+def rate_limiter(calls_per_minute: int = CALLS_PER_MINUTE) -> TokenBucket:
+    """
+    A bucket that lets at most calls_per_minute calls through in any 60 seconds:
+    a burst of half of them, then the other half refilled over the minute.
+    """
+    return TokenBucket(calls_per_minute / 120, calls_per_minute / 2)
+
+
 def chunk_points(lats: np.ndarray, lons: np.ndarray) -> List[Tuple[List[float], List[float]]]:
     """
     Split grid into chunks that stay under Open-Meteo's data limit.
@@ -32,10 +100,10 @@ def chunk_points(lats: np.ndarray, lons: np.ndarray) -> List[Tuple[List[float],
 
 
 def download_chunk(latitudes: List[float], longitudes: List[float],
-                   start_date: datetime.date, forecast_days: int) -> pd.DataFrame:
+                   start_date: datetime.date, forecast_days: int) -> list:
     """
     Download ensemble data for multiple points in one API call.
-    Returns DataFrame with columns: time, latitude, longitude, temperature_2m_mean, temperature_2m_std
+    Returns the responses, one per point, in the order of the points.
     """
     forecast_delta = datetime.timedelta(days=forecast_days - 1)
     end_date = start_date + forecast_delta
@@ -50,19 +118,64 @@ def download_chunk(latitudes: List[float], longitudes: List[float],
         "elevation": ["nan"] * len(latitudes),
     }
 
-    aggrs = {
-        'temperature_2m': {
-            'variable': Variable.temperature,
-            'filter': lambda v: v.Altitude() == 2,
-            'aggregations': [
-                ('mean', lambda x: np.mean(x, axis=0).astype("float32") + 273.15),
-                ('std', lambda x: np.std(x, axis=0).astype("float32")),
-            ]
-        }
-    }
+    return get_client().ensemble(params)
+
+
+def fill_chunk(responses: list, points: np.ndarray, times: pd.DatetimeIndex, mean: np.ndarray, std: np.ndarray):
+    """
+    Write the ensemble mean (in K) and spread of the 2 m temperature of the
+    responses into the (time, lat, lon) arrays mean and std. points are the flat
+    (lat * lon) indices of the points of the responses, times the times expected.
+    """
+    chunk_times, arrays = get_client().ensemble_arrays(responses, AGGRS)
+    if not chunk_times.equals(times):
+        raise ValueError(f"Unexpected times {chunk_times[0]} - {chunk_times[-1]}")
+
+    # Views of the arrays with the grid flattened, (time, lat * lon)
+    mean.reshape(len(times), -1)[:, points] = arrays['temperature_2m_mean'].T + 273.15
+    std.reshape(len(times), -1)[:, points] = arrays['temperature_2m_std'].T
+
+
+def download_grid(lats: np.ndarray, lons: np.ndarray, start_date: datetime.date, forecast_days: int,
+                  bucket: TokenBucket, workers: int = MAX_WORKERS) -> Tuple[pd.DatetimeIndex, np.ndarray, np.ndarray]:
+    """
+    Download the grid by chunks, in parallel, at most workers requests at a time
+    and within the budget of the bucket. A chunk that fails is retried on its own,
+    the others are kept. Returns the times and the (time, lat, lon) arrays of the
+    ensemble mean and spread.
+    """
+    times = pd.date_range(start_date, periods=forecast_days * 24, freq="h")
+    shape = (len(times), len(lats), len(lons))
+    mean = np.full(shape, np.nan, dtype="float32")
+    std = np.full(shape, np.nan, dtype="float32")
+
+    # The points of chunk_points are in row-major order, so the chunk at offset
+    # covers the flat indices from offset on
+    chunks = chunk_points(lats, lons)
+    offsets = np.cumsum([0] + [len(chunk_lats) for chunk_lats, chunk_lons in chunks[:-1]])
+
+    def download(chunk, offset):
+        chunk_lats, chunk_lons = chunk
+        for attempt in range(CHUNK_RETRIES + 1):
+            bucket.acquire(len(chunk_lats))
+            try:
+                responses = download_chunk(chunk_lats, chunk_lons, start_date, forecast_days)
+                fill_chunk(responses, np.arange(offset, offset + len(chunk_lats)), times, mean, std)
+            except Exception as exc:
+                if attempt == CHUNK_RETRIES:
+                    raise
+                delay = RETRY_DELAY * 2 ** attempt
+                print(f"Chunk at {chunk_lats[0]}, {chunk_lons[0]} failed, retrying in {delay}s: {exc}")
+                time.sleep(delay)
+            else:
+                print(f"Downloaded chunk: {len(chunk_lats)} points")
+                return
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        # list() to raise the errors
+        list(executor.map(download, chunks, offsets))
 
-    # ensemble_df handles single response with multiple locations
-    return om_client.ensemble_df(params, aggrs)
+    return times, mean, std
 
 
 def main():
@@ -99,12 +212,7 @@ def main():
     lats = np.arange(np.floor(minlat * 4) / 4, np.ceil(maxlat * 4) / 4, .25)
     lons = np.arange(np.floor(minlon * 4) / 4, np.ceil(maxlon * 4) / 4, .25)
 
-    # Preallocate dataset using first call
-    first_chunk = ([float(lats[0])], [float(lons[0])])
-
-    # Create lookup for fast indexing
-    lat_to_i = {float(lat): i for i, lat in enumerate(lats)}
-    lon_to_j = {float(lon): j for j, lon in enumerate(lons)}
+    bucket = rate_limiter()
 
     # Main loop
     for date in dates:
@@ -114,36 +222,17 @@ def main():
             print(f"Skipping {fout}, already exists")
             continue
 
-        df0 = download_chunk(*first_chunk, date, forecast_days)
-        times = df0['time'].unique()
+        times, mean, std = download_grid(lats, lons, date, forecast_days, bucket)
+
+        # The arrays are used as they are, not copied
         ds = xr.Dataset(
             data_vars={
-                "IFS_T_mea": (
-                    ("time", "lat", "lon"),
-                    np.full((len(times), len(lats), len(lons)), np.nan, dtype="float32"),
-                ),
-                "IFS_T_std": (
-                    ("time", "lat", "lon"),
-                    np.full((len(times), len(lats), len(lons)), np.nan, dtype="float32"),
-                ),
+                "IFS_T_mea": (("time", "lat", "lon"), mean),
+                "IFS_T_std": (("time", "lat", "lon"), std),
             },
             coords={"time": times, "lat": lats, "lon": lons},
         )
 
-        # Process in chunks
-        chunks = chunk_points(lats, lons)
-
-        for chunk_lats, chunk_lons in chunks:
-            print(f"Downloading chunk: {len(chunk_lats)} points")
-            df_chunk = download_chunk(chunk_lats, chunk_lons, date, forecast_days)
-
-            # Assign results to grid
-            for (lat, lon), group in df_chunk.groupby(['latitude', 'longitude']):
-                i = lat_to_i[float(lat)]
-                j = lon_to_j[float(lon)]
-                ds["IFS_T_mea"][:, i, j] = group['temperature_2m_mean'].values
-                ds["IFS_T_std"][:, i, j] = group['temperature_2m_std'].values
-
         # CF attributes
         ds.attrs = {
             "Conventions": "CF-1.6",
@@ -180,6 +269,8 @@ def main():
         print(f"Created NetCDF: {fout}")
 
     print("Open-Meteo IFS for the temperature grid - retrieval complete.")
+    client.evict_cache()
+    client.log_cache_stats()
 
 
 if __name__ == '__main__':
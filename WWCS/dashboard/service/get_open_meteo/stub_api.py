@@ -0,0 +1,147 @@
+"""
+Local stub of the Open-Meteo ensemble API, for bench_grid.py and the tests (no
+network, no API calls used).
+
+The stub answers in the FlatBuffers format of the API, with random values for 51
+members, after a delay (the latency, plus a time per location). Like the API, it
+refuses with HTTP 429 the calls over the per-minute budget, and some responses
+fail in the middle of the stream: the first fail_first ones, then at fail_rate.
+"""
+
+import collections
+import datetime
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+import flatbuffers
+import numpy as np
+from openmeteo_sdk.Variable import Variable
+
+
+MEMBERS = 51
+
+# Variables with their altitude, the others are looked up in Variable by name
+VARIABLES = {
+    'temperature_2m': (Variable.temperature, 2),
+}
+
+
+def encode_location(lat, lon, hourly, start, hours):
+    """A WeatherApiResponse message with the hourly variables of one location,
+    prefixed with its size.
+    """
+    builder = flatbuffers.Builder(1024)
+    variables = []
+    for name in hourly:
+        variable, altitude = VARIABLES[name] if name in VARIABLES else (getattr(Variable, name), 0)
+        for member in range(MEMBERS):
+            values = np.random.uniform(-10, 30, hours).astype('float32')
+            vector = builder.CreateNumpyVector(values)
+            builder.StartObject(11)
+            builder.PrependUint8Slot(0, variable, 0)
+            builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+            builder.PrependInt16Slot(5, altitude, 0)
+            builder.PrependInt16Slot(10, member, 0)
+            variables.append(builder.EndObject())
+
+    builder.StartVector(4, len(variables), 4)
+    for variable in reversed(variables):
+        builder.PrependUOffsetTRelative(variable)
+    vector = builder.EndVector()
+
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start, 0)
+    builder.PrependInt64Slot(1, start + hours * 3600, 0)
+    builder.PrependInt32Slot(2, 3600, 0)
+    builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+    variables_with_time = builder.EndObject()
+
+    # The API answers with the grid cell, like here with the 0.25° grid
+    builder.StartObject(12)
+    builder.PrependFloat32Slot(0, round(lat * 4) / 4, 0)
+    builder.PrependFloat32Slot(1, round(lon * 4) / 4, 0)
+    builder.PrependUOffsetTRelativeSlot(11, variables_with_time, 0)
+    builder.Finish(builder.EndObject())
+
+    message = builder.Output()
+    return len(message).to_bytes(4, 'little') + message
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+
+    def __init__(self, latency=0, latency_per_point=0, fail_rate=0, calls_per_minute=600, fail_first=0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.latency_per_point = latency_per_point
+        self.fail_rate = fail_rate
+        self.calls_per_minute = calls_per_minute
+        self.fail_first = fail_first
+        self.lock = threading.Lock()
+        self.calls = collections.deque()  # (time, locations) of the last minute
+        self.counters = collections.Counter()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/v1/ensemble'
+
+    def over_budget(self, n):
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and self.calls[0][0] < now - 60:
+                self.calls.popleft()
+            if sum(x for t, x in self.calls) + n > self.calls_per_minute:
+                return True
+            self.calls.append((now, n))
+            return False
+
+    def fail(self):
+        with self.lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return True
+        return random.random() < self.fail_rate
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type='application/octet-stream'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+
+        def floats(name):
+            # Lists are sent as repeated parameters or comma separated
+            return [float(x) for value in query[name] for x in value.split(',')]
+
+        lats, lons = floats('latitude'), floats('longitude')
+        hourly = [x for value in query['hourly'] for x in value.split(',')]
+        start = datetime.date.fromisoformat(query['start_date'][0])
+        end = datetime.date.fromisoformat(query['end_date'][0])
+        hours = ((end - start).days + 1) * 24
+
+        if self.server.over_budget(len(lats)):
+            self.server.counters['429'] += 1
+            body = {'error': True, 'reason': 'Minutely API request limit exceeded. Please try again in one minute.'}
+            return self.send(429, json.dumps(body).encode(), 'application/json')
+
+        time.sleep(self.server.latency + self.server.latency_per_point * len(lats))
+        if self.server.fail():
+            self.server.counters['failed'] += 1
+            return self.send(200, b'Unexpected error while streaming data')
+
+        self.server.counters['ok'] += 1
+        t0 = int(datetime.datetime(start.year, start.month, start.day, tzinfo=datetime.timezone.utc).timestamp())
+        body = b''.join(encode_location(lat, lon, hourly, t0, hours) for lat, lon in zip(lats, lons))
+        self.send(200, body)
@@ -0,0 +1,110 @@
+import datetime
+import threading
+
+import numpy as np
+import pytest
+
+import client
+import get_open_meteo_grid as grid
+from stub_api import StubServer, encode_location
+
+
+PARAMS = {
+    "latitude": [38.0],
+    "longitude": [69.0],
+    "hourly": ["temperature_2m"],
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-01",
+}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    server = StubServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('OPENMETEO_ENSEMBLE_URL', server.url)
+    monkeypatch.setattr(client, 'CACHE_PATH', tmp_path / 'cache.sqlite')
+    # New clients, for the stub and the cache above
+    monkeypatch.setattr(grid, 'local', threading.local())
+    monkeypatch.setattr(grid, 'RETRY_DELAY', 0.01)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_chunk_retry(server, monkeypatch):
+    # 2 chunks of 4 points, the first response is cut
+    monkeypatch.setattr(grid, 'MAX_POINTS', 4)
+    server.fail_first = 1
+    lats, lons = np.array([38.0, 38.25]), np.array([68.0, 68.25, 68.5, 68.75])
+
+    times, mean, std = grid.download_grid(lats, lons, datetime.date(2024, 1, 1), 1, grid.rate_limiter(), workers=2)
+    assert len(times) == 24
+    assert not np.isnan(mean).any() and not np.isnan(std).any()
+    # Only the failed chunk was downloaded again
+    assert server.counters == {'failed': 1, 'ok': 2}
+
+
+def test_chunk_retries_exhausted(server, monkeypatch):
+    monkeypatch.setattr(grid, 'CHUNK_RETRIES', 1)
+    server.fail_first = 2
+    with pytest.raises(Exception, match='Unexpected error'):
+        grid.download_grid(np.array([38.0]), np.array([68.0]), datetime.date(2024, 1, 1), 1, grid.rate_limiter())
+
+
+def test_incomplete_not_cached(server):
+    server.fail_first = 1
+    api = client.Client()
+    with pytest.raises(Exception, match='Unexpected error'):
+        api.ensemble(dict(PARAMS))
+
+    # The cut stream was not cached, the next call gets a complete response,
+    # which is then served from the cache
+    assert len(api.ensemble(dict(PARAMS))) == 1
+    assert len(api.ensemble(dict(PARAMS))) == 1
+    assert server.counters == {'failed': 1, 'ok': 1}
+
+
+def test_complete_response():
+    class Response:
+        def __init__(self, content):
+            self.content = content
+
+    message = encode_location(38.0, 69.0, ['temperature_2m'], 0, 24)
+    assert client.complete_response(Response(message + message))
+    assert not client.complete_response(Response(message + b'Unexpected error while streaming data'))
+    assert not client.complete_response(Response(b'Unexpected error while streaming data'))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_rate_limiter(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(grid, 'time', clock)
+    budget = 600
+    bucket = grid.rate_limiter(budget)
+
+    # Requests of 100 locations for 5 minutes
+    calls = []
+    while clock.now < 300:
+        bucket.acquire(100)
+        calls.append(clock.now)
+
+    calls = np.array(calls)
+    for t in calls:
+        in_minute = ((calls >= t) & (calls < t + 60)).sum()
+        assert in_minute * 100 <= budget
+
+    # Without waiting more than needed: the burst of half of the budget, then the
+    # refill of half of the budget per minute
+    assert len(calls) >= (budget / 2 + 5 * budget / 2) / 100 - 1
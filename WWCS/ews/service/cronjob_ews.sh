@@ -33,6 +33,9 @@ if [ -f "dashboard/ifsdata/tj_area_$today.nc" ]; then
   # touch restart.txt to force reload of the data in the dashboard
   touch dashboard/restart.txt
 
+  # touch the stamp file to invalidate the response cache of the API
+  ${my_dir}/../../touch_cache_stamp.sh
+
 else
   echo "New forecast not yet available"
 fi
@@ -13,3 +13,6 @@ cd /srv/shiny-server/planting/service/
 echo "=== CALCULATE IRRIGATION ADVICE ==="
 
 R CMD BATCH --no-save soilprediction.R soilprediction.out
+
+# touch the stamp file to invalidate the response cache of the API
+/home/wwcs/wwcs/WWCS/touch_cache_stamp.sh
@@ -0,0 +1,13 @@
+#!/bin/bash
+# Invalidate the response cache of the API (see API/README.txt): touch the stamp
+# file api_wwcs.py watches. Like the API, it is API_CACHE_STAMP from the
+# environment or the .env file of the repository, else API/cache_stamp.txt
+
+set -e
+
+root_dir="$(readlink -f "$(dirname "$(readlink -f "$0")")/..")"
+if [ -z "$API_CACHE_STAMP" ] && [ -f "$root_dir/.env" ]; then
+  API_CACHE_STAMP="$(sed -n "s/^API_CACHE_STAMP=[\"']\?\([^\"'# ]*\)[\"']\?\s*\(#.*\)\?$/\1/p" "$root_dir/.env" | tail -n 1)"
+fi
+
+touch "${API_CACHE_STAMP:-$root_dir/API/cache_stamp.txt}"